@@ -8,7 +8,7 @@
 #          The typical way to call this script is:
 #          python3 getFramegrabList.py <aux_data_file>
 #          Where <aux_data_file> is the json-formatted Aux Data Export from
-#          the sealog client.
+#          the sealog client, or an Event Export including aux data.
 #
 #          The output is sent to stdout so that it can be redriected to a
 #          file or subsequent processing step.
@@ -16,22 +16,27 @@
 #  Author: Webb Pinner webbpinner@gmail.com
 # Created: 2018-09-26
 
-import json
 import argparse
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__)))))
+
+from python_sealog.misc import getFramegrabListByFile
 
 if __name__ == '__main__':
 
   parser = argparse.ArgumentParser(description='Sealog framegrab file list retriever 2000')
+  parser.add_argument('-d', '--details', action='store_true', help='print the camera name, filename and event timestamp (when the file is an event export) separated by tabs')
   parser.add_argument('aux_data_file', help='sealog_aux_data_file')
 
   args = parser.parse_args()
 
-  f = open(args.aux_data_file)
-  r = json.loads(f.read())
-
-  for data in r:
-    if data['data_source'] == "vehicleRealtimeFramegrabberData":
-      for framegrab in data['data_array']:
-        if framegrab['data_name'] == 'filename':
-          print(framegrab['data_value'])
+  # The export is parsed as it is read, so even very large ones are fine
+  for framegrab in getFramegrabListByFile(args.aux_data_file, args.details):
+    if args.details:
+      print('\t'.join(str(field) for field in framegrab))
+    else:
+      print(framegrab)
 
@@ -14,14 +14,20 @@
 import requests
 import json
 import argparse
-import csv
+import math
 import sys
 import os
 import shutil
-from datetime import datetime
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+from urllib3.exceptions import NewConnectionError
 
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 
+from python_sealog.event_aux_data import getEventAuxDataByLowering
 from python_sealog.settings import apiServerURL, eventsAPIPath, \
                                    eventAuxDataAPIPath, headers, \
                                    loweringsAPIPath
@@ -32,6 +38,37 @@ auxDataTemplate = {
     'data_array': []
 }
 
+# Each worker thread keeps its own session so connections are reused
+thread_local = threading.local()
+
+def get_session():
+    if not hasattr(thread_local, 'session'):
+        thread_local.session = requests.Session()
+        thread_local.session.headers.update(headers)
+    return thread_local.session
+
+# Limits posts to rate per second on average, allowing bursts of up to burst
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
 def get_events(lowering_uid):
     try:
         r = requests.get(f'{apiServerURL}/{eventsAPIPath}/bylowering/{lowering_uid}', headers=headers)
@@ -53,68 +90,305 @@ def get_lowering_uid(lowering_id):
         print(error)
         return None
 
+def build_renav_record(event, latitude, longitude, heading, depth, altitude):
+    ppi_data = {}
+    ppi_data['event_id'] = event['id']
+    ppi_data['data_source'] = "vehicleReNavData"
+    ppi_data['data_array'] = []
+    ppi_data['data_array'].append({ 'data_name': "latitude",'data_value': latitude, 'data_uom': 'ddeg' })
+    ppi_data['data_array'].append({ 'data_name': "longitude",'data_value': longitude, 'data_uom': 'ddeg' })
+    ppi_data['data_array'].append({ 'data_name': "heading",'data_value': heading, 'data_uom': 'deg' })
+    ppi_data['data_array'].append({ 'data_name': "depth",'data_value': depth, 'data_uom': 'meters' })
+    ppi_data['data_array'].append({ 'data_name': "altitude",'data_value': altitude, 'data_uom': 'meters' })
+    return ppi_data
+
 def match_ppi_to_event(ppi_file, events):
 
-    # print(json.dumps(events, indent=2))
+    # Index the events by their timestamp truncated to the second, i.e.
+    # '2019-05-11T12:34:56', so each ppi row is matched with a dict lookup
+    events_by_second = {}
     for event in events:
-        event['ts'] = datetime.strptime(event['ts'], '%Y-%m-%dT%H:%M:%S.%fZ').strftime('%Y-%m-%dT%H:%M:%S.000Z')
+        events_by_second.setdefault(event['ts'][:19], []).append(event)
 
     ppi_data_array = []
+    ppi_rows = 0
+
+    with open(ppi_file) as f:
+        for line in f:
+            # Rows look like '2019/05/11 12:34:56.789 lat lon depth heading x y altitude'
+            row = line.split()
+            if len(row) < 9:
+                continue
+            ppi_rows += 1
+
+            ppi_ts = row[0].replace('/', '-') + 'T' + row[1][:8]
+
+            # Only the first ppi row within each second is used for an event
+            for event in events_by_second.pop(ppi_ts, []):
+                ppi_data_array.append(build_renav_record(event, row[2], row[3], row[5], row[4], row[8]))
+
+    unmatched = sum(len(v) for v in events_by_second.values())
+    print("Read", ppi_rows, "ppi rows;", len(ppi_data_array), "events matched,", unmatched, "unmatched")
+
+    return ppi_data_array
+
+# Returns the ppi timestamps, in seconds since the epoch, and their latitude,
+# longitude, depth, heading and altitude, sorted by time, along with the
+# number of rows skipped because they could not be parsed
+def load_ppi(ppi_file):
+
+    timestamps = []
+    values = []
+    skipped = 0
 
     with open(ppi_file) as f:
-        reader = csv.reader(f, delimiter=" ", skipinitialspace=True)
-        # header = next(reader) # skip header
-
-        for row in reader:
-            
-            ppi_ts = datetime.strptime(row[0] + ' ' + row[1], '%Y/%m/%d %H:%M:%S.%f').strftime('%Y-%m-%dT%H:%M:%S.000Z')
-            eventIDArray = filter(lambda event: event['ts'] == ppi_ts, events)
-
-            for event in eventIDArray:
-                # print("event:", json.dumps(event))
-                ppi_data = {}
-                ppi_data['event_id'] = event['id']
-                ppi_data['data_source'] = "vehicleReNavData"
-                ppi_data['data_array'] = []
-                ppi_data['data_array'].append({ 'data_name': "latitude",'data_value': row[2], 'data_uom': 'ddeg' })
-                ppi_data['data_array'].append({ 'data_name': "longitude",'data_value': row[3], 'data_uom': 'ddeg' })
-                ppi_data['data_array'].append({ 'data_name': "heading",'data_value': row[5], 'data_uom': 'deg' })
-                ppi_data['data_array'].append({ 'data_name': "depth",'data_value': row[4], 'data_uom': 'meters' })
-                ppi_data['data_array'].append({ 'data_name': "altitude",'data_value': row[8], 'data_uom': 'meters' })
-
-                # ppi_data_array.append(ppi_data)
-                print("Adding Aux Data Record to event:", event['ts'], '-->', event['event_value'])
-
-                try:
-                    r = requests.post(f'{apiServerURL}/{eventAuxDataAPIPath}', headers=headers, data = json.dumps(ppi_data))
-                    #Copy file
-                except Exception as error:
-                    print("Error:", error)
-                    print("Event:", event)
-
-                # print("event:", json.dumps(event))
-                # ppi_data = {}
-                # ppi_data['event_id'] = event['id']
-                # ppi_data['data_source'] = "vehicleReNavAlvinCoordData"
-                # ppi_data['data_array'] = []
-                # ppi_data['data_array'].append({ 'data_name': "alvin_x",'data_value': row[6], 'data_uom': 'meters' })
-                # ppi_data['data_array'].append({ 'data_name': "alvin_y",'data_value': row[7], 'data_uom': 'meters' })
-
-                # # ppi_data_array.append(ppi_data)
-                # print("Adding Aux Data Record to event:", event['ts'], '-->', event['event_value'])
-
-                # try:
-                #     r = requests.post(f'{apiServerURL}/{eventAuxDataAPIPath}', headers=headers, data = json.dumps(ppi_data))
-                #     #Copy file
-                # except Exception as error:
-                #     print("Error:", error)
-                #     print("Event:", event)
+        for line in f:
+            # Rows look like '2019/05/11 12:34:56.789 lat lon depth heading x y altitude'
+            row = line.split()
+            if len(row) < 9:
+                continue
+
+            # Skip headers and truncated or corrupt rows rather than failing
+            # the whole file
+            try:
+                ts = np.datetime64(row[0].replace('/', '-') + 'T' + row[1], 'ms')
+                value = tuple(float(row[i]) for i in (2, 3, 4, 5, 8))
+            except ValueError:
+                skipped += 1
+                continue
+            if np.isnat(ts) or not all(math.isfinite(v) for v in value):
+                skipped += 1
+                continue
+
+            timestamps.append(ts)
+            values.append(value)
+
+    # Seconds since the epoch, sorted in case the file isn't
+    times = np.array(timestamps, dtype='datetime64[ms]').astype(np.float64) / 1000
+    values = np.array(values, dtype=np.float64).reshape(-1, 5)
+    order = np.argsort(times, kind='stable')
+
+    return times[order], values[order], skipped
+
+# Interpolate an angle in degrees, going the short way around the circle
+def interp_angle(x, xp, fp):
+
+    unwrapped = np.unwrap(np.radians(fp))
+    return np.degrees(np.interp(x, xp, unwrapped))
+
+def interpolate_ppi_to_event(ppi_file, events, max_gap):
+
+    times, values, skipped = load_ppi(ppi_file)
+    if skipped:
+        print("Skipped", skipped, "ppi rows that could not be parsed")
+    if len(times) == 0:
+        print("Read 0 ppi rows; 0 events interpolated,", len(events), "unmatched")
+        return []
+
+    event_times = np.array([event['ts'].rstrip('Z') for event in events],
+                           dtype='datetime64[ms]').astype(np.float64) / 1000
+
+    # An event can only be interpolated if it lies between two samples no more
+    # than max_gap seconds apart, or exactly on a sample
+    after = np.searchsorted(times, event_times, side='right')
+    before = np.clip(after - 1, 0, len(times) - 1)
+    after = np.clip(after, 0, len(times) - 1)
+    valid = (event_times >= times[0]) & (
+        (times[before] == event_times) |
+        ((times[after] > event_times) & (times[after] - times[before] <= max_gap))
+    )
+
+    latitude = np.interp(event_times, times, values[:, 0])
+    longitude = (interp_angle(event_times, times, values[:, 1]) + 180) % 360 - 180
+    depth = np.interp(event_times, times, values[:, 2])
+    heading = interp_angle(event_times, times, values[:, 3]) % 360
+    altitude = np.interp(event_times, times, values[:, 4])
+
+    ppi_data_array = []
+    for i in np.flatnonzero(valid):
+        ppi_data_array.append(build_renav_record(
+            events[i],
+            f'{latitude[i]:.7f}', f'{longitude[i]:.7f}', f'{heading[i]:.2f}',
+            f'{depth[i]:.2f}', f'{altitude[i]:.2f}'))
+
+    print("Read", len(times), "ppi rows;", len(ppi_data_array), "events interpolated,", len(events) - len(ppi_data_array), "unmatched")
+
+    return ppi_data_array
+
+# Renav records already in Sealog for the lowering, by event_id
+def get_existing_renav(lowering_uid):
+
+    existing = {}
+    for aux_data in getEventAuxDataByLowering(lowering_uid, 'vehicleReNavData') or []:
+        # Earlier runs may have left duplicates; the first one is kept up to date
+        existing.setdefault(aux_data['event_id'], aux_data)
+    return existing
+
+def same_data_array(a, b):
+
+    a = {d['data_name']: d['data_value'] for d in a}
+    b = {d['data_name']: d['data_value'] for d in b}
+    if a.keys() != b.keys():
+        return False
+
+    for name, value in a.items():
+        try:
+            if not math.isclose(float(value), float(b[name]), abs_tol=1e-9):
+                return False
+        except (TypeError, ValueError):
+            if str(value) != str(b[name]):
+                return False
+    return True
+
+# Splits the records into ones to post and ones to patch over an existing
+# record, leaving out those that are already in Sealog or in the checkpoint
+def plan_renav_records(ppi_data_array, existing, done):
+
+    to_post = []
+    to_patch = []
+    unchanged = 0
+
+    for ppi_data in ppi_data_array:
+        if ppi_data['event_id'] in done:
+            unchanged += 1
+            continue
+
+        current = existing.get(ppi_data['event_id'])
+        if current is None:
+            to_post.append(ppi_data)
+        elif same_data_array(current['data_array'], ppi_data['data_array']):
+            unchanged += 1
+        else:
+            to_patch.append((current['id'], ppi_data))
+
+    print(len(to_post), "records to add,", len(to_patch), "to update,", unchanged, "already up to date")
+
+    return to_post, to_patch
+
+# The checkpoint holds one event_id per line for each record sent so far,
+# after a header identifying the ppi file so a stale checkpoint is ignored
+def checkpoint_header(ppi_file):
+
+    stat = os.stat(ppi_file)
+    return f'# {os.path.abspath(ppi_file)} {stat.st_size} {stat.st_mtime_ns}\n'
+
+def load_checkpoint(checkpoint_file, ppi_file):
+
+    try:
+        with open(checkpoint_file) as f:
+            if f.readline() != checkpoint_header(ppi_file):
+                print("Ignoring checkpoint", checkpoint_file, "from a different ppi file")
+                return set()
+            done = set(line.strip() for line in f if line.strip())
+    except FileNotFoundError:
+        return set()
+
+    print("Resuming from checkpoint with", len(done), "records already sent")
+    return done
+
+def open_checkpoint(checkpoint_file, ppi_file, done):
+
+    f = open(checkpoint_file, 'w')
+    f.write(checkpoint_header(ppi_file))
+    f.writelines(event_id + '\n' for event_id in done)
+    f.flush()
+    return f
+
+# True if a request failed while connecting, before anything was sent
+def failed_to_connect(error):
+
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+# Send one record, retrying with exponential backoff. Records with an
+# aux_data_uid replace that record, which is safe to repeat, so those are
+# retried after connection errors, timeouts, 429s and 5xxs. A new record may
+# have been stored even though the post failed, so posts are only retried
+# after a 429 or a failure to connect. Other failures are left to a rerun,
+# which patches the record if it was stored.
+def post_renav_record(ppi_data, bucket, retries, aux_data_uid=None):
+
+    for attempt in range(retries + 1):
+        if bucket:
+            bucket.acquire()
+
+        try:
+            if aux_data_uid:
+                r = get_session().patch(f'{apiServerURL}/{eventAuxDataAPIPath}/{aux_data_uid}', json={'data_array': ppi_data['data_array']}, timeout=30)
+            else:
+                r = get_session().post(f'{apiServerURL}/{eventAuxDataAPIPath}', json=ppi_data, timeout=30)
+            if r.status_code != 429 and r.status_code < 500:
+                r.raise_for_status()
+                return
+            error = requests.HTTPError(f'{r.status_code} {r.reason}', response=r)
+            if not aux_data_uid and r.status_code != 429:
+                raise error
+        except (requests.ConnectionError, requests.Timeout) as e:
+            error = e
+            if not aux_data_uid and not failed_to_connect(e):
+                raise
+
+        if attempt < retries:
+            time.sleep(min(30, 0.5 * 2 ** attempt))
+
+    raise error
+
+def post_renav_records(to_post, to_patch, events, checkpoint=None, workers=8, rate=0, retries=3):
+
+    # Sealog has no bulk aux data endpoint, so records are posted one at a
+    # time but from several threads at once
+    events_by_id = {event['id']: event for event in events}
+    bucket = TokenBucket(rate, max(1, workers)) if rate > 0 else None
+
+    posted = 0
+    failed = 0
+    start = time.monotonic()
+    last_report = start
+
+    total = len(to_post) + len(to_patch)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(post_renav_record, ppi_data, bucket, retries, aux_data_uid): ppi_data
+            for aux_data_uid, ppi_data in [(None, p) for p in to_post] + to_patch
+        }
+
+        for future in as_completed(futures):
+            try:
+                future.result()
+                posted += 1
+                if checkpoint:
+                    checkpoint.write(futures[future]['event_id'] + '\n')
+                    checkpoint.flush()
+            except Exception as error:
+                failed += 1
+                event = events_by_id[futures[future]['event_id']]
+                print("Error:", error)
+                print("Event:", event['id'], event['ts'], '-->', event['event_value'])
+
+            now = time.monotonic()
+            if now - last_report >= 1:
+                last_report = now
+                print(f"Posted {posted}/{total} records ({posted / (now - start):.1f}/s)")
+
+    elapsed = time.monotonic() - start
+    print(f"Posted {posted} records in {elapsed:.1f}s ({posted / max(elapsed, 1e-6):.1f}/s), {failed} failed")
+
+    return failed
 
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description='Sealog ReNav Inserter 2000')
     parser.add_argument('lowering_id', help='The lowering to process (i.e. 5001)')
     parser.add_argument('ppi_file', help='The ppi file containing the timestamps and postions for the stills')
+    parser.add_argument('--max-gap', type=float, default=5.0, help='Don\'t interpolate across ppi samples more than this many seconds apart (default: 5)')
+    parser.add_argument('--exact', action='store_true', help='Only use ppi rows from the same second as each event, instead of interpolating')
+    parser.add_argument('--workers', type=int, default=8, help='Number of records to post concurrently (default: 8)')
+    parser.add_argument('--rate', type=float, default=0, help='Maximum records posted per second, or 0 for no limit (default: 0)')
+    parser.add_argument('--retries', type=int, default=3, help='Times to retry a failed post (default: 3)')
+    parser.add_argument('--checkpoint', help='File recording which records have been sent, so an interrupted run can resume (default: <ppi_file>.<lowering_id>.checkpoint)')
 
     args = parser.parse_args()
 
@@ -131,4 +405,21 @@ if __name__ == '__main__':
     print("lowering_uid:", lowering_uid)
     lowering_events = get_events(lowering_uid)
 
-    match_ppi_to_event(args.ppi_file, lowering_events)
+    if args.exact:
+        ppi_data_array = match_ppi_to_event(args.ppi_file, lowering_events)
+    else:
+        ppi_data_array = interpolate_ppi_to_event(args.ppi_file, lowering_events, args.max_gap)
+    checkpoint_file = args.checkpoint or f'{args.ppi_file}.{args.lowering_id}.checkpoint'
+    done = load_checkpoint(checkpoint_file, args.ppi_file)
+
+    existing = get_existing_renav(lowering_uid)
+    to_post, to_patch = plan_renav_records(ppi_data_array, existing, done)
+
+    with open_checkpoint(checkpoint_file, args.ppi_file, done) as checkpoint:
+        failed = post_renav_records(to_post, to_patch, lowering_events, checkpoint, args.workers, args.rate, args.retries)
+
+    if failed:
+        print("Rerun to retry the failed records")
+        sys.exit(1)
+
+    os.remove(checkpoint_file)
@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+#
+#  Purpose: This script backs up the Sealog data for a lowering to disk:
+#           the lowering record, events, aux data, event exports as JSON
+#           and CSV, event templates and the lowering's framegrabs, plus the
+#           cruise record when a cruise ID is given. It is a replacement
+#           for sealog_postdive.sh.
+#
+#           All of the exports are downloaded at once and streamed to disk,
+#           framegrabs are copied by a pool of workers, and a manifest
+#           listing the size and sha256 checksum of every file is written
+#           alongside the backup.
+#
+#    Usage: Type python3 sealog-postdive.py -? for full usage information.
+#
+#           The typical way to call this script is:
+#           python3 sealog-postdive.py [-d dest_dir] [-c cruise_id] <lowering_id>
+#
+#           Pass -y to skip the confirmation prompts, e.g. when running
+#           from cron.
+#
+#           Backups are incremental: every export is downloaded in full,
+#           so edits, deletions and late renav or framegrab records are
+#           always picked up, but exports whose contents have not changed
+#           are left untouched on disk, only new or changed framegrabs are
+#           copied, and an interrupted run picks up where it stopped.
+
+import aiohttp
+import asyncio
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import python_sealog.settings
+from python_sealog.settings import cruisesAPIPath, eventAuxDataAPIPath, \
+                                   eventExportsAPIPath, eventsAPIPath, \
+                                   eventTemplatesAPIPath, headers, \
+                                   loweringsAPIPath
+
+BACKUP_DIR_ROOT = '/home/jason/sealog-backup'
+FRAMEGRAB_DIR = 'images'
+SULISCAM_DIR = 'images/SulisCam'
+SULISCAM_SRC_DIR = '/home/jason/sealog-files/images/SulisCam'
+
+CHUNK_SIZE = 1024 * 1024
+
+def confirm(prompt, assume_yes):
+
+    if assume_yes:
+        return True
+    answer = input(prompt + ' (Y/N): ')
+    return answer.lower() in ('y', 'yes')
+
+# The manifest records the size, mtime and sha256 of every file in the
+# backup, so that later runs only rewrite and copy what has changed since.
+# Files are keyed by their path relative to root, so that the same file is
+# found however the backup directory was spelled on the command line.
+class Manifest:
+    def __init__(self, path, root):
+        self.path = path
+        self.root = root
+        self.files = {}
+
+        if os.path.isfile(path):
+            with open(path) as f:
+                data = json.load(f)
+            entries = data if isinstance(data, list) else data['files']
+            for entry in entries:
+                self.files[os.path.normpath(entry['path'])] = entry
+
+    def key(self, path):
+        return os.path.relpath(path, self.root)
+
+    def sha256(self, path):
+        entry = self.files.get(self.key(path))
+        return entry and entry['sha256']
+
+    def record(self, path, size, sha256):
+        stat = os.stat(path)
+        self.files[self.key(path)] = {
+            'path': self.key(path),
+            'size': size,
+            'mtime': stat.st_mtime,
+            'sha256': sha256
+        }
+
+    # True if path is on disk exactly as it was when last recorded
+    def unchanged(self, path):
+        entry = self.files.get(self.key(path))
+        if not entry or 'mtime' not in entry:
+            return False
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return False
+        return stat.st_size == entry['size'] and stat.st_mtime == entry['mtime']
+
+    def save(self):
+        data = {
+            'files': [self.files[key] for key in sorted(self.files)]
+        }
+        tmp_path = self.path + '.part'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+# Write a response body to path as it arrives, via a temporary file so an
+# interrupted download never leaves a truncated export behind. If the
+# result is identical to what is already there, the old file is kept.
+# Returns True if the file changed.
+async def download(session, url, path, manifest):
+
+    async with session.get(url) as r:
+        if r.status == 404:
+            print("Nothing to export from", url)
+            return False
+        r.raise_for_status()
+
+        sha256 = hashlib.sha256()
+        size = 0
+        tmp_path = path + '.part'
+        with open(tmp_path, 'wb') as f:
+            async for chunk in r.content.iter_chunked(CHUNK_SIZE):
+                await asyncio.to_thread(f.write, chunk)
+                sha256.update(chunk)
+                size += len(chunk)
+
+    if manifest.unchanged(path) and manifest.sha256(path) == sha256.hexdigest():
+        os.remove(tmp_path)
+        print("Unchanged", os.path.basename(path))
+        return False
+
+    os.replace(tmp_path, path)
+    manifest.record(path, size, sha256.hexdigest())
+    print("Exported", os.path.basename(path))
+    return True
+
+def hash_file(path):
+
+    sha256 = hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            sha256.update(chunk)
+            size += len(chunk)
+    return size, sha256.hexdigest()
+
+# Copy src to dst, hashing the data on the way through
+def copy_and_hash(src, dst):
+
+    sha256 = hashlib.sha256()
+    size = 0
+    tmp_path = dst + '.part'
+    with open(src, 'rb') as fsrc, open(tmp_path, 'wb') as fdst:
+        while True:
+            chunk = fsrc.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            fdst.write(chunk)
+            sha256.update(chunk)
+            size += len(chunk)
+    shutil.copystat(src, tmp_path)
+    os.replace(tmp_path, dst)
+
+    return size, sha256.hexdigest()
+
+# Copy an image unless dst already matches src by size and mtime. Returns
+# None if dst is already in the manifest as it is, otherwise its size and
+# sha256.
+def copy_image(src, dst, known):
+
+    src_stat = os.stat(src)
+    try:
+        dst_stat = os.stat(dst)
+    except FileNotFoundError:
+        dst_stat = None
+
+    if dst_stat and dst_stat.st_size == src_stat.st_size and dst_stat.st_mtime == src_stat.st_mtime:
+        return None if known else hash_file(dst)
+
+    return copy_and_hash(src, dst)
+
+def get_framegrab_list(aux_data_file):
+
+    if not os.path.isfile(aux_data_file):
+        return []
+    return getFramegrabListByFile(aux_data_file)
+
+def get_suliscam_list(events_file):
+
+    if not os.path.isfile(events_file):
+        return []
+
+    filenames = []
+    for event in iterJSONArrayFromFile(events_file):
+        if event['event_value'] == "SulisCam":
+            for option in event['event_options']:
+                if option['event_option_name'] == 'filename':
+                    filenames.append(option['event_option_value'])
+    return filenames
+
+# exports are (url, path) pairs, all downloaded at once
+async def export_records(exports, manifest, workers):
+
+    api = python_sealog.settings.apiServerURL
+
+    async with aiohttp.ClientSession(headers=headers, connector=aiohttp.TCPConnector(limit=workers)) as session:
+        jobs = [download(session, f'{api}{url}', path, manifest) for url, path in exports]
+        results = await asyncio.gather(*jobs, return_exceptions=True)
+
+    failed = 0
+    for (url, path), result in zip(exports, results):
+        if isinstance(result, Exception):
+            print("Error exporting", url + ":", result)
+            failed += 1
+
+    return failed
+
+def copy_images(copies, manifest, workers):
+
+    copied = 0
+    unchanged = 0
+    failed = 0
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(copy_image, src, dst, manifest.unchanged(dst)): (src, dst)
+                for src, dst in copies
+            }
+
+            for n, future in enumerate(futures, 1):
+                src, dst = futures[future]
+                try:
+                    result = future.result()
+                    if result is None:
+                        unchanged += 1
+                    else:
+                        manifest.record(dst, *result)
+                        copied += 1
+                except Exception as error:
+                    print("Error copying", src + ":", error)
+                    failed += 1
+
+                # Save progress now and then so an interrupted run can resume
+                if n % 100 == 0 or n == len(futures):
+                    print(f"Checked {n}/{len(futures)} images, {copied} copied")
+                    manifest.save()
+    finally:
+        manifest.save()
+
+    print("Copied", copied, "images,", unchanged, "already backed up,", failed, "failed")
+    return failed
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Sealog post-dive backup')
+    parser.add_argument('-d', dest='dest_dir', default=BACKUP_DIR_ROOT, help=f'Where to store the backup (default: {BACKUP_DIR_ROOT})')
+    parser.add_argument('-c', dest='cruise_id', help='The cruise ID for the lowering. If given, the backup is stored within a <cruise_id> directory along with the cruise record')
+    parser.add_argument('-s', dest='suliscam', action='store_true', help='Also copy SulisCam images, if SulisCam was used during the dive')
+    parser.add_argument('-y', '--yes', action='store_true', help='Don\'t ask for confirmation, e.g. when run from cron')
+    parser.add_argument('--url', default=python_sealog.settings.apiServerURL, help='URL of the Sealog API server as seen from this host')
+    parser.add_argument('--framegrab-src', default=python_sealog.settings.apiServerFilePath + '/images', help='Directory the framegrab paths in the aux data are relative to')
+    parser.add_argument('--suliscam-src', default=SULISCAM_SRC_DIR, help=f'Directory holding SulisCam images (default: {SULISCAM_SRC_DIR})')
+    parser.add_argument('--workers', type=int, default=8, help='Number of downloads and copies to run at once (default: 8)')
+    parser.add_argument('lowering_id', help='The lowering ID, i.e. J2-1107')
+
+    args = parser.parse_args()
+
+    # Override python_sealog's server URL, then do late import of API
+    python_sealog.settings.apiServerURL = args.url
+
+    from python_sealog.cruises import getCruiseByID
+    from python_sealog.lowerings import getLoweringByID
+    from python_sealog.misc import getFramegrabListByFile, iterJSONArrayFromFile
+
+    cruise = None
+    if args.cruise_id:
+        cruise = getCruiseByID(args.cruise_id)
+        if not cruise:
+            print("Unable to find cruise data for cruise id:", args.cruise_id)
+            sys.exit(1)
+        print("CRUISE_OID:", cruise['id'])
+
+    lowering = getLoweringByID(args.lowering_id)
+    if not lowering:
+        print("Unable to find lowering data for dive id:", args.lowering_id)
+        sys.exit(1)
+    print("LOWERING_OID:", lowering['id'])
+
+    backup_dir = os.path.join(args.dest_dir, args.cruise_id) if args.cruise_id else args.dest_dir
+    lowering_dir = os.path.join(backup_dir, args.lowering_id)
+
+    print("-----------------------------------------------------")
+    print("Backup Directory:", lowering_dir)
+    print("-----------------------------------------------------")
+    if not confirm("Continue?", args.yes):
+        sys.exit(1)
+
+    if not os.path.isdir(lowering_dir):
+        if not confirm("Create backup directory?", args.yes):
+            sys.exit(1)
+    os.makedirs(os.path.join(lowering_dir, FRAMEGRAB_DIR), exist_ok=True)
+    if args.suliscam:
+        os.makedirs(os.path.join(lowering_dir, SULISCAM_DIR), exist_ok=True)
+
+    lowering_oid = lowering['id']
+    lowering_path = lambda name: os.path.join(lowering_dir, f'{args.lowering_id}_{name}')
+
+    manifest = Manifest(lowering_path('manifest.json'), lowering_dir)
+
+    exports = [
+        (f'{loweringsAPIPath}/{lowering_oid}', lowering_path('loweringRecord.json')),
+        (eventTemplatesAPIPath, lowering_path('eventTemplates.json')),
+        (f'{eventsAPIPath}/bylowering/{lowering_oid}', lowering_path('eventOnlyExport.json')),
+        (f'{eventAuxDataAPIPath}/bylowering/{lowering_oid}', lowering_path('auxDataExport.json')),
+        (f'{eventExportsAPIPath}/bylowering/{lowering_oid}', lowering_path('sealogExport.json')),
+        (f'{eventExportsAPIPath}/bylowering/{lowering_oid}?format=csv', lowering_path('sealogExport.csv')),
+    ]
+    if cruise:
+        exports += [
+            (f'{cruisesAPIPath}/{cruise["id"]}', os.path.join(backup_dir, f'{args.cruise_id}_cruiseRecord.json')),
+            (eventTemplatesAPIPath, os.path.join(backup_dir, f'{args.cruise_id}_eventTemplates.json')),
+        ]
+
+    failed = asyncio.run(export_records(exports, manifest, args.workers))
+    manifest.save()
+
+    copies = [
+        (args.framegrab_src + filename, os.path.join(lowering_dir, FRAMEGRAB_DIR, os.path.basename(filename)))
+        for filename in get_framegrab_list(lowering_path('auxDataExport.json'))
+    ]
+    if args.suliscam:
+        copies += [
+            (os.path.join(args.suliscam_src, filename), os.path.join(lowering_dir, SULISCAM_DIR, os.path.basename(filename)))
+            for filename in get_suliscam_list(lowering_path('eventOnlyExport.json'))
+        ]
+
+    print("Checking", len(copies), "images")
+    copy_failed = copy_images(copies, manifest, args.workers)
+
+    if failed or copy_failed:
+        print(f"Done, but {failed} exports and {copy_failed} copies failed")
+        sys.exit(1)
+    print("Done!")
@@ -18,13 +18,14 @@
 #  Created: 2018-09-26
 # Modified: 2019-02-11
 
-import requests
-import json
+import aiohttp
+import asyncio
 import argparse
 import csv
 import sys
 import os
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
@@ -46,92 +47,173 @@ eventTemplate = {
   "event_free_text": ""
 }
 
-def translate_file_to_events(ppfx_file, source_dir):
-
-    with open(ppfx_file) as f:
-        reader = csv.reader(f, delimiter=" ", skipinitialspace=True)
-        header = next(reader)
-
-        for row in reader:
-
-            imagePath = os.path.join(source_dir, row[3])
-            if not os.path.isfile(imagePath):
-                print("Could not locate", imagePath)
-                continue
+# Copy src to dst with the kernel doing the work where it can
+def copy_file_contents(src, dst):
+
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        size = os.fstat(fsrc.fileno()).st_size
+        copied = 0
+
+        try:
+            while copied < size:
+                if hasattr(os, 'copy_file_range'):
+                    n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), size - copied)
+                else:
+                    n = os.sendfile(fdst.fileno(), fsrc.fileno(), copied, size - copied)
+                if n == 0:
+                    break
+                copied += n
+        except (AttributeError, OSError):
+            # Not supported here (e.g. across some filesystems), so start over
+            fsrc.seek(0)
+            fdst.seek(0)
+            fdst.truncate()
+            shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+
+# Copy an image into DEST_IMAGE_DIRECTORY unless an identical copy, going by
+# size and mtime, is already there. Returns True if the file was copied.
+def copy_still(imagePath):
+
+    destPath = os.path.join(DEST_IMAGE_DIRECTORY, os.path.basename(imagePath))
+    src = os.stat(imagePath)
+
+    try:
+        dst = os.stat(destPath)
+        if dst.st_size == src.st_size and int(dst.st_mtime) == int(src.st_mtime):
+            return False
+    except FileNotFoundError:
+        pass
+
+    tmpPath = destPath + '.part'
+    copy_file_contents(imagePath, tmpPath)
+    shutil.copystat(imagePath, tmpPath)
+    os.replace(tmpPath, destPath)
+    return True
+
+def build_event(row):
+
+    event = dict(eventTemplate)
+    event['event_options'] = [
+        {
+            'event_option_name': 'filename',
+            'event_option_value': row[3]
+        }
+    ]
+    event['ts'] = datetime.strptime(row[0] + ' ' + row[1], '%Y/%m/%d %H:%M:%S.%f').strftime('%Y-%m-%dT%H:%M:%S.000Z')
+    return event
+
+def build_aux_data(event_id, row):
+
+    # Add renav aux data entry
+    renavData = dict(auxDataTemplate)
+
+    renavData['event_id'] = event_id
+    renavData['data_source'] = "vehicleReNavData"
+    renavData['data_array'] = []
+
+    renavData['data_array'].append({ 'data_name': "latitude",'data_value': row[4], 'data_uom': 'ddeg' })
+    renavData['data_array'].append({ 'data_name': "longitude",'data_value': row[5], 'data_uom': 'ddeg' })
+    renavData['data_array'].append({ 'data_name': "heading",'data_value': row[6], 'data_uom': 'deg' })
+    renavData['data_array'].append({ 'data_name': "depth",'data_value': row[7], 'data_uom': 'meters' })
+    renavData['data_array'].append({ 'data_name': "altitude",'data_value': row[8], 'data_uom': 'meters' })
+    renavData['data_array'].append({ 'data_name': "pitch",'data_value': row[9], 'data_uom': 'deg' })
+    renavData['data_array'].append({ 'data_name': "roll",'data_value': row[10], 'data_uom': 'deg' })
+
+    # Add framegrabber aux data entry
+    framegrabberData = dict(auxDataTemplate)
+    framegrabberData['event_id'] = event_id
+    framegrabberData['data_source'] = "vehicleRealtimeFramegrabberData"
+    framegrabberData['data_array'] = []
+    framegrabberData['data_array'].append({ 'data_name': "camera_name", 'data_value': "SulisCam" })
+    framegrabberData['data_array'].append({ 'data_name': "filename", 'data_value': row[3] })
+
+    return renavData, framegrabberData
+
+class StillImporter:
+    def __init__(self, session, copy_pool, max_requests):
+        self.session = session
+        self.copy_pool = copy_pool
+        self.requests = asyncio.Semaphore(max_requests)
+        self.counts = dict.fromkeys(('copied', 'unchanged', 'copy_failed', 'events', 'event_failed', 'aux_failed'), 0)
+
+    async def post(self, path, data):
+
+        async with self.requests:
+            async with self.session.post(f'{apiServerURL}/{path}', json=data) as r:
+                r.raise_for_status()
+                return await r.json()
+
+    async def copy(self, imagePath):
+
+        loop = asyncio.get_running_loop()
+        try:
+            if await loop.run_in_executor(self.copy_pool, copy_still, imagePath):
+                self.counts['copied'] += 1
             else:
-                print("Copying", row[3], "to", DEST_IMAGE_DIRECTORY)
-                try:
-                    shutil.copy2(imagePath, DEST_IMAGE_DIRECTORY)
-                except Exception as error:
-                    print(error)
-
-            event = eventTemplate
-            event['event_options'] = [
-                {
-                    'event_option_name': 'filename',
-                    'event_option_value': row[3]
-                }
-            ]
-            event['ts'] = datetime.strptime(row[0] + ' ' + row[1], '%Y/%m/%d %H:%M:%S.%f').strftime('%Y-%m-%dT%H:%M:%S.000Z')
-            print("Adding Event Record")
+                self.counts['unchanged'] += 1
+        except Exception as error:
+            self.counts['copy_failed'] += 1
+            print("Error copying", imagePath + ":", error)
 
-            try:
-                r = requests.post(f'{apiServerURL}/{eventsAPIPath}', headers=headers, data = json.dumps(event))
-                responseObj = json.loads(r.text)
+    async def post_aux_data(self, aux_data, event):
+
+        try:
+            await self.post(eventAuxDataAPIPath, aux_data)
+        except Exception as error:
+            self.counts['aux_failed'] += 1
+            print("Error adding", aux_data['data_source'], "record:", error)
+            print(event)
 
-                print(f'{apiServerURL}/{eventsAPIPath}')
-                print(json.dumps(event))
-                print(responseObj)
+    async def add_event(self, row):
 
-                # Add renav aux data entry
-                renavData = auxDataTemplate
+        event = build_event(row)
+        try:
+            responseObj = await self.post(eventsAPIPath, event)
+        except Exception as error:
+            self.counts['event_failed'] += 1
+            print(error)
+            print(event)
+            return
+        self.counts['events'] += 1
 
-                renavData['event_id'] = responseObj['insertedId']
-                renavData['data_source'] = "vehicleReNavData"
-                renavData['data_array'] = []
+        await asyncio.gather(*(self.post_aux_data(aux_data, event) for aux_data in build_aux_data(responseObj['insertedId'], row)))
 
-                renavData['data_array'].append({ 'data_name': "latitude",'data_value': row[4], 'data_uom': 'ddeg' })
-                renavData['data_array'].append({ 'data_name': "longitude",'data_value': row[5], 'data_uom': 'ddeg' })
-                renavData['data_array'].append({ 'data_name': "heading",'data_value': row[6], 'data_uom': 'deg' })
-                renavData['data_array'].append({ 'data_name': "depth",'data_value': row[7], 'data_uom': 'meters' })
-                renavData['data_array'].append({ 'data_name': "altitude",'data_value': row[8], 'data_uom': 'meters' })
-                renavData['data_array'].append({ 'data_name': "pitch",'data_value': row[9], 'data_uom': 'deg' })
-                renavData['data_array'].append({ 'data_name': "roll",'data_value': row[10], 'data_uom': 'deg' })
+    # The copy runs in the thread pool while the event and its aux data are
+    # posted, and many stills are in flight at once
+    async def import_still(self, row, source_dir):
 
-                print("Adding Renav Aux Data Record")
+        imagePath = os.path.join(source_dir, row[3])
+        if not os.path.isfile(imagePath):
+            print("Could not locate", imagePath)
+            return
 
-                try:
-                    r = requests.post(f'{apiServerURL}/{eventAuxDataAPIPath}', headers=headers, data = json.dumps(renavData))
-                except Exception as error:
-                    print(error)
-                    print(event)
+        await asyncio.gather(self.copy(imagePath), self.add_event(row))
 
-                # Add framegrabber aux data entry
-                framegrabberData = auxDataTemplate
-                framegrabberData['event_id'] = responseObj['insertedId']
-                framegrabberData['data_source'] = "vehicleRealtimeFramegrabberData"
-                framegrabberData['data_array'] = []
-                framegrabberData['data_array'].append({ 'data_name': "camera_name", 'data_value': "SulisCam" })
-                framegrabberData['data_array'].append({ 'data_name': "filename", 'data_value': row[3] })
+async def translate_file_to_events(ppfx_file, source_dir, copy_workers=4, max_requests=8):
 
-                print("Adding framegrabber Aux Data Record")
+    with open(ppfx_file) as f:
+        reader = csv.reader(f, delimiter=" ", skipinitialspace=True)
+        header = next(reader)
+        rows = list(reader)
 
-                try:
-                    r = requests.post(f'{apiServerURL}/{eventAuxDataAPIPath}', headers=headers, data = json.dumps(framegrabberData))
-                except Exception as error:
-                    print(error)
-                    print(event)
+    print("Importing", len(rows), "stills to", DEST_IMAGE_DIRECTORY)
 
+    with ThreadPoolExecutor(max_workers=copy_workers) as copy_pool:
+        async with aiohttp.ClientSession(headers=headers) as session:
+            importer = StillImporter(session, copy_pool, max_requests)
+            await asyncio.gather(*(importer.import_still(row, source_dir) for row in rows))
 
-            except Exception as error:
-                print(error)
-                print(event)
+    counts = importer.counts
+    print("Copied", counts['copied'], "stills,", counts['unchanged'], "already up to date,", counts['copy_failed'], "failed")
+    print("Added", counts['events'], "events,", counts['event_failed'], "failed;", counts['aux_failed'], "aux data records failed")
 
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description='SulisCam Still Sealog Event Inserter 2000')
     parser.add_argument('source_dir', help='The directory containing the stills')
     parser.add_argument('ppfx_file', help='The ppfx file containing the timestamps and postions for the stills')
+    parser.add_argument('--copy-workers', type=int, default=4, help='Number of stills to copy at once (default: 4)')
+    parser.add_argument('--max-requests', type=int, default=8, help='Number of requests to Sealog in flight at once (default: 8)')
 
     args = parser.parse_args()
 
@@ -146,6 +228,6 @@ if __name__ == '__main__':
             except OSError: print ('Error: Creating directory.')
 
     if os.path.isdir(args.source_dir):
-        translate_file_to_events(args.ppfx_file, args.source_dir)
+        asyncio.run(translate_file_to_events(args.ppfx_file, args.source_dir, args.copy_workers, args.max_requests))
     else:
         print("Source directory:", args.source_dir, "does not exist")
@@ -11,7 +11,7 @@ def getEventAuxDataByCruise(cruise_uid, datasource=""):
         url = apiServerURL + eventAuxDataAPIPath + "/bycruise/" + cruise_uid
 
         if datasource != "":
-            url += "&datasource=" + datasource
+            url += "?datasource=" + datasource
 
         r = requests.get(url, headers=headers)
 
@@ -31,13 +31,14 @@ def getEventAuxDataByLowering(lowering_uid, datasource=""):
         url = apiServerURL + eventAuxDataAPIPath + "/bylowering/" + lowering_uid
 
         if datasource != "":
-            url += "&datasource=" + datasource
+            url += "?datasource=" + datasource
 
         r = requests.get(url, headers=headers)
 
-        eventAuxData = json.loads(r.text)
-        logging.debug(json.dumps(eventAuxData))
-        return eventAuxData
+        if r.status_code != 404:
+            eventAuxData = json.loads(r.text)
+            logging.debug(json.dumps(eventAuxData))
+            return eventAuxData
 
     except Exception as error:
         logging.debug(str(error))
@@ -0,0 +1,190 @@
+import bisect
+import datetime
+import json
+import logging
+import os
+import re
+import socket
+import time
+from collections import namedtuple
+
+from .settings import apiServerURL
+from .cruises import getCruises
+from .lowerings import getLowerings
+
+
+Interval = namedtuple(
+    "Interval", "start stop lowering_uid lowering_id cruise_id"
+)
+
+# Matches timestamps like 2024-01-02T03:04:05.678Z as well as the compact
+# 20240102_030405678 form used in framegrab filenames
+TIMESTAMP_RE = re.compile(
+    r"(\d{4})-?(\d{2})-?(\d{2})[T_ ]?(\d{2}):?(\d{2}):?(\d{2})(?:\.?(\d{1,6}))?"
+)
+
+
+# Return the POSIX time of an ISO 8601 timestamp, assuming UTC if no
+# timezone is given.
+def parseTimestamp(ts):
+    ts = datetime.datetime.fromisoformat(ts.replace("Z", "+00:00"))
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=datetime.timezone.utc)
+    return ts.timestamp()
+
+
+# Return the POSIX time of the first timestamp found in text, such as a
+# filename, or None if there is none.
+def findTimestamp(text):
+    match = TIMESTAMP_RE.search(text)
+    if match is None:
+        return None
+
+    year, month, day, hour, minute, second, fraction = match.groups()
+    try:
+        ts = datetime.datetime(
+            int(year), int(month), int(day), int(hour), int(minute),
+            int(second), int((fraction or "0").ljust(6, "0")),
+            tzinfo=datetime.timezone.utc)
+    except ValueError:
+        return None
+    return ts.timestamp()
+
+
+# Sorted interval index of lowerings, for looking up the lowering and
+# cruise that a point in time belongs to. built_at is the POSIX time the
+# records were fetched from the API.
+class LoweringIndex:
+    def __init__(self, intervals, built_at=None):
+        self.intervals = sorted(intervals)
+        self.built_at = time.time() if built_at is None else built_at
+        self.starts = [i.start for i in self.intervals]
+
+        # Latest stop time among this and all earlier-starting lowerings, so
+        # lookups can stop walking back as soon as nothing earlier can match
+        self.max_stops = []
+        max_stop = float("-inf")
+        for interval in self.intervals:
+            max_stop = max(max_stop, interval.stop)
+            self.max_stops.append(max_stop)
+
+    @classmethod
+    def fromRecords(cls, lowerings, cruises):
+        cruise_windows = [
+            (parseTimestamp(c["start_ts"]), parseTimestamp(c["stop_ts"]),
+             c["cruise_id"])
+            for c in cruises or []
+        ]
+
+        intervals = []
+        for lowering in lowerings or []:
+            start = parseTimestamp(lowering["start_ts"])
+            stop = parseTimestamp(lowering["stop_ts"])
+
+            # A lowering belongs to the cruise whose window contains it
+            cruise_id = next((
+                cruise_id for c_start, c_stop, cruise_id in cruise_windows
+                if c_start <= start and stop <= c_stop
+            ), None)
+
+            intervals.append(Interval(start, stop, lowering["id"],
+                                      lowering["lowering_id"], cruise_id))
+        return cls(intervals)
+
+    # Return the Interval containing the POSIX time ts, or None.
+    def lookup(self, ts):
+        i = bisect.bisect_right(self.starts, ts) - 1
+        while i >= 0 and self.max_stops[i] > ts:
+            if ts < self.intervals[i].stop:
+                return self.intervals[i]
+            i -= 1
+        return None
+
+    # Look up an ISO 8601 timestamp, or a filename with a timestamp in it.
+    def lookupText(self, text):
+        try:
+            ts = parseTimestamp(text)
+        except ValueError:
+            ts = findTimestamp(os.path.basename(text))
+        return self.lookup(ts) if ts is not None else None
+
+    def toJSON(self):
+        return [list(i) for i in self.intervals]
+
+    @classmethod
+    def fromJSON(cls, data, built_at=None):
+        return cls((Interval(*i) for i in data), built_at)
+
+
+def buildLoweringIndex():
+
+    try:
+        return LoweringIndex.fromRecords(getLowerings(), getCruises())
+
+    except Exception as error:
+        logging.error(str(error))
+        raise error
+
+
+# Return a LoweringIndex, read from cache_file if it was written for the
+# same server less than ttl seconds ago, and otherwise built from the API
+# and saved to cache_file.
+def loadLoweringIndex(cache_file=None, ttl=300):
+    if cache_file:
+        try:
+            mtime = os.path.getmtime(cache_file)
+            if time.time() - mtime < ttl:
+                with open(cache_file) as f:
+                    cache = json.load(f)
+                if cache.get("url") == apiServerURL:
+                    return LoweringIndex.fromJSON(cache["intervals"], mtime)
+        except (OSError, ValueError, KeyError, TypeError) as error:
+            logging.debug("Ignoring lowering index cache: %s", error)
+
+    index = buildLoweringIndex()
+
+    if cache_file:
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(cache_file)),
+                        exist_ok=True)
+            tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+            with open(tmp_file, "w") as f:
+                json.dump({"url": apiServerURL,
+                           "intervals": index.toJSON()}, f)
+            os.replace(tmp_file, cache_file)
+        except OSError as error:
+            logging.warning("Could not write lowering index cache: %s", error)
+
+    return index
+
+
+# Client for sealog-loweringResolver.py. Queries are timestamps or filenames,
+# one per line, and each is answered with a (lowering_id, cruise_id) tuple,
+# either of which may be None.
+class LoweringResolverClient:
+    def __init__(self, socket_path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(socket_path)
+        self.file = self.sock.makefile("rw")
+
+    def lookup(self, text):
+        self.file.write(text.replace("\n", " ") + "\n")
+        self.file.flush()
+
+        reply = self.file.readline()
+        if not reply:
+            raise ConnectionError("Lowering resolver closed the connection")
+
+        lowering_id, cruise_id = reply.rstrip("\n").split("\t")
+        return (None if lowering_id == "null" else lowering_id,
+                None if cruise_id == "null" else cruise_id)
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
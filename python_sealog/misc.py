@@ -7,91 +7,155 @@ from .settings import (
     apiServerFilePath,
     headers,
     eventAuxDataAPIPath,
+    eventExportsAPIPath,
 )
 
 dataSourceFilter = ["vehicleRealtimeFramegrabberData"]
 imagePath = apiServerFilePath + "/images"
 
-
-def getFramegrabListByLowering(lowering_uid):
+chunkSize = 64 * 1024
+
+
+# Yield the elements of a top-level JSON array one at a time from an
+# iterable of text chunks, so only one element needs to be in memory at once
+def iterJSONArray(chunks):
+    decoder = json.JSONDecoder()
+    buf = ""
+    pos = 0
+    started = False
+    done = False
+
+    for chunk in chunks:
+        buf = buf[pos:] + chunk
+        pos = 0
+
+        while True:
+            # Skip whitespace, the opening bracket and separating commas
+            while pos < len(buf):
+                c = buf[pos]
+                if c == "[" and not started:
+                    started = True
+                elif c == "]" and started:
+                    done = True
+                elif c not in " \t\r\n" and not (c == "," and started):
+                    break
+                pos += 1
+
+            if done:
+                return
+            if pos >= len(buf) or not started:
+                break
+
+            try:
+                element, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                # The element continues in the next chunk
+                break
+
+            # A number or literal that isn't followed by a delimiter yet may
+            # continue in the next chunk too
+            if buf[pos] not in "{[\"" and (
+                end == len(buf) or buf[end] not in " \t\r\n,]"
+            ):
+                break
+
+            yield element
+            pos = end
+
+    if buf[pos:].strip():
+        raise ValueError("Unexpected end of JSON array")
+
+
+def iterJSONArrayFromFile(filename):
+    with open(filename) as f:
+        yield from iterJSONArray(iter(lambda: f.read(chunkSize), ""))
+
+
+def iterJSONArrayFromURL(url):
+    with requests.get(url, headers=headers, stream=True) as r:
+        if r.status_code == 404:
+            return
+        r.raise_for_status()
+
+        if r.encoding is None:
+            r.encoding = "utf-8"
+        yield from iterJSONArray(r.iter_content(chunkSize, decode_unicode=True))
+
+
+# Yield the framegrabs in a stream of aux data records, or of event export
+# records which carry their aux data along with the event's timestamp. With
+# details, (camera_name, filename, ts) tuples are yielded instead of just
+# filenames, with ts None when the records don't include it.
+def iterFramegrabs(records, details=False):
+    for record in records:
+        if "aux_data" in record:
+            auxData = record["aux_data"] or []
+        else:
+            auxData = [record]
+
+        for data in auxData:
+            if data.get("data_source") not in dataSourceFilter:
+                continue
+
+            cameraName = None
+            for framegrab in data["data_array"]:
+                if framegrab["data_name"] == "camera_name":
+                    cameraName = framegrab["data_value"]
+                elif framegrab["data_name"] == "filename":
+                    if details:
+                        yield (cameraName, framegrab["data_value"], record.get("ts"))
+                    else:
+                        yield framegrab["data_value"]
+
+
+def getFramegrabListByLowering(lowering_uid, details=False):
     logging.debug("Exporting event data")
     query = "&data_source=".join(dataSourceFilter)
 
-    framegrabFilenames = []
-
     try:
+        # Only the event exports include the event timestamps
         url = (
             apiServerURL
-            + eventAuxDataAPIPath
+            + (eventExportsAPIPath if details else eventAuxDataAPIPath)
             + "/bylowering/"
             + lowering_uid
             + "?datasource="
             + query
         )
         logging.debug("URL: " + url)
-        r = requests.get(url, headers=headers)
-
-        if r.status_code != 404:
-            framegrabs = json.loads(r.text)
-            for data in framegrabs:
-                for framegrab in data["data_array"]:
-                    if framegrab["data_name"] == "filename":
-                        framegrabFilenames.append(framegrab["data_value"])
+        yield from iterFramegrabs(iterJSONArrayFromURL(url), details)
 
     except Exception as error:
         logging.error(str(error))
 
-    return framegrabFilenames
 
-
-def getFramegrabListByCruise(cruise_uid):
+def getFramegrabListByCruise(cruise_uid, details=False):
     logging.debug("Exporting event data")
     query = "&data_source=".join(dataSourceFilter)
 
-    framegrabFilenames = []
-
     try:
+        # Only the event exports include the event timestamps
         url = (
             apiServerURL
-            + eventAuxDataAPIPath
+            + (eventExportsAPIPath if details else eventAuxDataAPIPath)
             + "/bycruise/"
             + cruise_uid
             + "?datasource="
             + query
         )
         logging.debug("URL: " + url)
-        r = requests.get(url, headers=headers)
-
-        if r.status_code != 404:
-            framegrabs = json.loads(r.text)
-            for data in framegrabs:
-                for framegrab in data["data_array"]:
-                    if framegrab["data_name"] == "filename":
-                        framegrabFilenames.append(framegrab["data_value"])
+        yield from iterFramegrabs(iterJSONArrayFromURL(url), details)
 
     except Exception as error:
         logging.error(str(error))
 
-    return framegrabFilenames
-
 
-def getFramegrabListByFile(filename):
+def getFramegrabListByFile(filename, details=False):
 
     logging.debug(filename)
-    framegrabFilenames = []
 
     try:
-        f = open(filename)
-        r = json.loads(f.read())
-        # logging.debug(r)
-
-        for data in r:
-            if data["data_source"] in dataSourceFilter:
-                for framegrab in data["data_array"]:
-                    if framegrab["data_name"] == "filename":
-                        framegrabFilenames.append(framegrab["data_value"])
+        yield from iterFramegrabs(iterJSONArrayFromFile(filename), details)
 
     except Exception as error:
         logging.error(str(error))
-
-    return framegrabFilenames
@@ -2,62 +2,312 @@
 '''
 This service submits ASNAP events to Sealog at the specified interval so long
 as Sealog says ASNAPs be created.
+
+The ASNAP status is read whenever the websocket (re)connects and then followed
+through custom variable updates published over it. If the connection drops,
+it is retried with a growing delay while the current status is kept.
+
+Events are scheduled on multiples of the interval, e.g. at :00, :10, :20 for
+a 10 second interval.
+
+Several independent ASNAP streams can be run from one process by passing a
+JSON config file with --config, which holds a list of streams like:
+
+    [
+        {
+            "custom_var": "asnapStatus",
+            "interval": 10,
+            "event_value": "ASNAP",
+            "event_options": [],
+            "event_free_text": ""
+        },
+        {
+            "custom_var": "scienceAsnapStatus",
+            "interval": 60,
+            "event_value": "SCIENCE_ASNAP",
+            "event_options": [
+                {"event_option_name": "source", "event_option_value": "auto"}
+            ]
+        }
+    ]
+
+Only custom_var and interval are required. The streams share one HTTP session
+and one websocket connection.
 '''
 
 import argparse
+import asyncio
+import datetime
+import json
 import logging
+import math
+import sys
 import time
 
-import requests
+import aiohttp
+import websockets
 
 from python_sealog.settings import apiServerURL, customVarAPIPath, \
-                                   eventsAPIPath, headers
+                                   eventsAPIPath, headers, wsServerURL
 
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__file__)
 
 
-ASNAP_STATUS_VAR_NAME = 'asnapStatus'
+DEFAULT_STATUS_VAR_NAME = 'asnapStatus'
+
+DEFAULT_EVENT_VALUE = 'ASNAP'
+
+CLIENT_WSID = 'asnap'
 
-EVENT_TEMPLATE = {
-    'event_value': 'ASNAP',
-    'event_options': [],
-    'event_free_text': '',
+HELLO = {
+    'type': 'hello',
+    'id': CLIENT_WSID,
+    'auth': {'headers': headers},
+    'version': '2',
+    'subs': ['/ws/status/updateCustomVars'],
 }
 
+PING = {
+    'type': 'ping',
+    'id': CLIENT_WSID,
+}
+
+# Seconds to wait before reconnecting to the websocket, doubled after each
+# failed attempt up to the maximum
+RECONNECT_DELAY = 1
+
+MAX_RECONNECT_DELAY = 60
+
+ARGS = None
+
+HTTP_SESSION = None
+
+STREAMS = []
+
+# Posts in flight. The event loop only keeps weak references to tasks, so
+# these are held here until they finish.
+POST_TASKS = set()
 
-def is_asnap_enabled():
-    response = requests.get(
+
+# One ASNAP schedule: the custom variable that turns it on and off, how often
+# it fires, and the event it posts.
+class AsnapStream:
+    def __init__(self, status_var_name, interval, event_template):
+        self.status_var_name = status_var_name
+        self.status_var_id = None
+        self.interval = interval
+        self.event_template = event_template
+        self.enabled = False
+
+    @property
+    def name(self):
+        return self.event_template['event_value']
+
+    def set_enabled(self, enabled):
+        if enabled != self.enabled:
+            logger.info('%s is now %s', self.name, 'on' if enabled else 'off')
+        self.enabled = enabled
+
+    def matches(self, var):
+        return var.get('id') == self.status_var_id or \
+            var.get('custom_var_name') == self.status_var_name
+
+
+def load_streams(filename):
+    with open(filename) as f:
+        config = json.load(f)
+
+    streams = []
+    for entry in config:
+        streams.append(AsnapStream(
+            entry['custom_var'],
+            entry['interval'],
+            {
+                'event_value': entry.get('event_value', DEFAULT_EVENT_VALUE),
+                'event_options': entry.get('event_options', []),
+                'event_free_text': entry.get('event_free_text', ''),
+            },
+        ))
+    return streams
+
+
+class UnknownCustomVar(Exception):
+    pass
+
+
+async def get_asnap_status(stream):
+    async with HTTP_SESSION.get(
         f'{apiServerURL}{customVarAPIPath}',
-        params={'name': ASNAP_STATUS_VAR_NAME},
+        params={'name': stream.status_var_name},
         headers=headers,
-    ).json()
+    ) as r:
+        response = await r.json()
     assert type(response) == type([])
-    return response[0]['custom_var_value'] == 'On'
+    if not response:
+        raise UnknownCustomVar(
+            f'No custom variable named {stream.status_var_name}')
 
+    stream.status_var_id = response[0]['id']
+    stream.set_enabled(response[0]['custom_var_value'] == 'On')
 
-def post_asnap_event():
-    requests.post(
-        f'{apiServerURL}{eventsAPIPath}',
-        headers=headers,
-        json=EVENT_TEMPLATE,
-    )
+
+async def post_asnap_event(stream, slot):
+    event = dict(stream.event_template,
+                 ts=datetime.datetime.utcfromtimestamp(slot)
+                 .strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z')
+    try:
+        async with HTTP_SESSION.post(
+            f'{apiServerURL}{eventsAPIPath}',
+            headers=headers,
+            json=event,
+        ) as r:
+            r.raise_for_status()
+    except:
+        logger.exception('An error occurred while performing %s', stream.name)
+
+
+# Posts an event on every multiple of the stream's interval while the stream
+# is enabled.
+#
+# Slots are computed from the wall clock but waited for with the event loop's
+# monotonic timer, and posts happen in the background, so that time spent
+# posting does not push later slots back.
+# If we fall behind, up to --max-catchup missed slots are posted late and the
+# rest are skipped.
+async def asnap_scheduler(stream):
+    interval = stream.interval
+    slot = math.ceil(time.time() / interval) * interval
+
+    while True:
+        await asyncio.sleep(max(0, slot - time.time()))
+
+        missed = math.floor((time.time() - slot) / interval)
+        if missed > ARGS.max_catchup:
+            logger.warning('Skipping %d missed %s slots',
+                           missed - ARGS.max_catchup, stream.name)
+            slot += (missed - ARGS.max_catchup) * interval
+            missed = ARGS.max_catchup
+
+        for _ in range(missed + 1):
+            if stream.enabled:
+                task = asyncio.create_task(post_asnap_event(stream, slot))
+                POST_TASKS.add(task)
+                task.add_done_callback(POST_TASKS.discard)
+            slot += interval
+
+
+async def event_listener():
+    delay = RECONNECT_DELAY
+
+    while True:
+        try:
+            async with websockets.connect(wsServerURL) as websocket:
+                await websocket.send(json.dumps(HELLO))
+
+                # Pick up any change we missed while we were not subscribed.
+                # A stream whose status can't be read keeps its current one.
+                results = await asyncio.gather(
+                    *(get_asnap_status(s) for s in STREAMS),
+                    return_exceptions=True)
+                for stream, result in zip(STREAMS, results):
+                    if isinstance(result, Exception):
+                        logger.error('Could not read the status of %s',
+                                     stream.name, exc_info=result)
+                logger.info('Connected to %s', wsServerURL)
+                delay = RECONNECT_DELAY
+
+                while True:
+                    try:
+                        msg = json.loads(await websocket.recv())
+
+                        if msg.get('type') == 'ping':
+                            logger.debug('Acknowledging ping from server')
+                            await websocket.send(json.dumps(PING))
+                        elif msg.get('type') == 'pub':
+                            var = msg.get('message', {})
+                            if 'custom_var_value' not in var:
+                                continue
+                            for stream in STREAMS:
+                                if stream.matches(var):
+                                    stream.set_enabled(
+                                        var['custom_var_value'] == 'On')
+                        else:
+                            logger.debug('Ignoring message of type '
+                                         f'{msg.get("type")}')
+                    except websockets.exceptions.ConnectionClosed:
+                        raise
+                    except Exception:
+                        logger.exception(
+                            'An exception occurred while processing a message')
+        except websockets.exceptions.ConnectionClosed:
+            logger.error('The connection to the server was lost')
+        except Exception:
+            logger.exception('Could not connect to the server')
+
+        logger.info('Reconnecting in %d seconds', delay)
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+
+# Checks that every stream's custom variable exists, so that a typo in the
+# config is reported at startup rather than leaving the stream off forever.
+# Other errors, e.g. the server still starting, are left to the listener to
+# retry.
+async def check_streams():
+    results = await asyncio.gather(
+        *(get_asnap_status(s) for s in STREAMS), return_exceptions=True)
+    for stream, result in zip(STREAMS, results):
+        if isinstance(result, UnknownCustomVar):
+            logger.error('Cannot run %s: %s', stream.name, result)
+            sys.exit(1)
+        if isinstance(result, Exception):
+            logger.warning('Could not read the status of %s: %s',
+                           stream.name, result)
+
+
+async def main():
+    global HTTP_SESSION
+
+    async with aiohttp.ClientSession() as HTTP_SESSION:
+        await check_streams()
+
+        schedulers = [asyncio.create_task(asnap_scheduler(s))
+                      for s in STREAMS]
+        try:
+            await event_listener()
+        finally:
+            for scheduler in schedulers:
+                scheduler.cancel()
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument('-i', '--interval', type=int, default=10,
                         help='ASNAP interval in seconds')
-    args = parser.parse_args()
+    parser.add_argument('--custom-var', default=DEFAULT_STATUS_VAR_NAME,
+                        help='Custom variable that turns ASNAP on and off')
+    parser.add_argument('--event-value', default=DEFAULT_EVENT_VALUE,
+                        help='Event value to post')
+    parser.add_argument('--config',
+                        help='JSON file listing several ASNAP streams; '
+                             'overrides -i, --custom-var and --event-value')
+    parser.add_argument('--max-catchup', type=int, default=1,
+                        help='Maximum number of missed ASNAP slots to post '
+                             'late after a stall')
+    ARGS = parser.parse_args()
 
-    while True:
-        try:
-            if is_asnap_enabled():
-                post_asnap_event()
-        except KeyboardInterrupt:
-            quit()
-        except:
-            logger.exception('An error occurred while performing ASNAP')
-        finally:
-            time.sleep(args.interval)
+    if ARGS.config:
+        STREAMS = load_streams(ARGS.config)
+    else:
+        STREAMS = [AsnapStream(ARGS.custom_var, ARGS.interval, {
+            'event_value': ARGS.event_value,
+            'event_options': [],
+            'event_free_text': '',
+        })]
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
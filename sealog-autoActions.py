@@ -3,18 +3,38 @@
 This service listens for new events submitted to Sealog and performs additional 
 actions depending on the recieved event.
 
-This service listens for 'Off deck' and 'On deck' milestones and enables/
-disables the ASNAP functionality and if a lowering is currently active it will
-set the start/stop time to the time of the event.
-
-This service listens for 'On bottom' and 'Off bottom' milestones and if a 
-lowering is currently active it will set the lowering_on/off_bottom milestone 
-time to the time of the event.
+By default, this service listens for 'Alvin off deck' and 'Alvin on deck'
+milestones and, if a lowering is currently active, sets its start/stop time to
+the time of the event.
+
+It also listens for 'On bottom' and 'Off bottom' milestones, enables/disables
+the ASNAP functionality, and if a lowering is currently active it will set the
+lowering_on/off_bottom milestone time to the time of the event.
+
+These rules can be replaced with a JSON file passed to --rules, which is
+reloaded whenever it changes. It contains a list of rules like:
+
+    {
+        "event_value": "VEHICLE",
+        "option_name": "milestone",
+        "option_value": "On bottom",
+        "actions": [
+            {"action": "set_custom_var", "name": "asnapStatus", "value": "On"},
+            {"action": "stamp_lowering_milestone", "milestone": "on_bottom"},
+            {"action": "post_aux_data", "data_source": "...",
+             "data_array": [...]}
+        ]
+    }
 '''
 
+import argparse
 import asyncio
+import copy
+import datetime
+import functools
 import json
 import logging
+import os
 import time
 
 import requests
@@ -22,16 +42,15 @@ import websockets
 
 from python_sealog.custom_vars import getCustomVarUIDByName, setCustomVar
 from python_sealog.lowerings import getLoweringByEvent
-from python_sealog.settings import apiServerURL, headers, loweringsAPIPath, \
-                                   wsServerURL
+from python_sealog.settings import apiServerURL, eventAuxDataAPIPath, \
+                                   headers, loweringsAPIPath, wsServerURL
 
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__file__)
 
 
-ASNAP_STATUS_VAR_NAME = 'asnapStatus'
-ASNAP_STATUS_VAR_ID = None
+ARGS = None
 
 CLIENT_WSID = 'autoActions'
 
@@ -40,7 +59,9 @@ HELLO = {
     'id': CLIENT_WSID,
     'auth': {'headers': headers},
     'version': '2',
-    'subs': ['/ws/status/newEvents', '/ws/status/updateEvents'],
+    'subs': ['/ws/status/newEvents', '/ws/status/updateEvents',
+             '/ws/status/newLowerings', '/ws/status/updateLowerings',
+             '/ws/status/deleteLowerings'],
 }
 
 PING = {
@@ -54,24 +75,128 @@ AUX_DATA_TEMPLATE = {
     'data_array': [],
 }
 
+# The lowering that the most recent milestone belonged to. Events that fall
+# between its start and stop times are assumed to belong to it too.
+ACTIVE_LOWERING = None
+
+# The rules used when no --rules file is given
+DEFAULT_RULES = [
+    {
+        'event_value': 'VEHICLE',
+        'option_name': 'milestone',
+        'option_value': 'Alvin off deck',
+        'actions': [
+            {'action': 'stamp_lowering_milestone', 'milestone': 'start'},
+        ],
+    },
+    {
+        'event_value': 'VEHICLE',
+        'option_name': 'milestone',
+        'option_value': 'On bottom',
+        'actions': [
+            {'action': 'set_custom_var', 'name': 'asnapStatus', 'value': 'On'},
+            {'action': 'stamp_lowering_milestone', 'milestone': 'on_bottom'},
+        ],
+    },
+    {
+        'event_value': 'VEHICLE',
+        'option_name': 'milestone',
+        'option_value': 'Off bottom',
+        'actions': [
+            {'action': 'set_custom_var', 'name': 'asnapStatus',
+             'value': 'Off'},
+            {'action': 'stamp_lowering_milestone', 'milestone': 'off_bottom'},
+        ],
+    },
+    {
+        'event_value': 'VEHICLE',
+        'option_name': 'milestone',
+        'option_value': 'Alvin on deck',
+        'actions': [
+            {'action': 'stamp_lowering_milestone', 'milestone': 'stop'},
+        ],
+    },
+]
+
+# Compiled rules, mapping (event_value, option_name, option_value) to a list of
+# actions, each of which takes the event as its only argument.
+RULES = {}
+RULES_MTIME = None
+
+# Custom variable IDs, keyed by name
+CUSTOM_VAR_IDS = {}
+
+
+def resolve_custom_var_id(name):
+    if name not in CUSTOM_VAR_IDS:
+        var_id = getCustomVarUIDByName(name)
+        if var_id is None:
+            raise ValueError(f'Unknown custom variable {name}')
+        CUSTOM_VAR_IDS[name] = var_id
+        logger.info(f'Got {name} variable ID: {var_id}')
+    return CUSTOM_VAR_IDS[name]
+
+
+async def set_custom_var(action, event):
+    logger.info(f'Setting {action["name"]} to {action["value"]}')
+    await asyncio.to_thread(setCustomVar, CUSTOM_VAR_IDS[action['name']],
+                            action['value'])
+
+
+async def post_aux_data(action, event):
+    aux_data = dict(AUX_DATA_TEMPLATE,
+                    event_id=event['message']['id'],
+                    data_source=action['data_source'],
+                    data_array=action['data_array'])
+
+    logger.info(f'Adding {action["data_source"]} aux data to event '
+                f'{event["message"]["id"]}')
+    await asyncio.to_thread(
+        requests.post,
+        f'{apiServerURL}{eventAuxDataAPIPath}',
+        headers=headers,
+        json=aux_data,
+    )
+
+
+def parse_ts(ts):
+    return datetime.datetime.fromisoformat(ts.replace('Z', '+00:00'))
+
+
+async def get_lowering(event):
+    global ACTIVE_LOWERING
 
-def init_asnap_status_var_id():
-    global ASNAP_STATUS_VAR_ID
-    ASNAP_STATUS_VAR_ID = getCustomVarUIDByName(ASNAP_STATUS_VAR_NAME)
-    logging.info(f'Got asnapStatus variable ID: {ASNAP_STATUS_VAR_ID}') 
+    ts = parse_ts(event['message']['ts'])
+    if ACTIVE_LOWERING and parse_ts(ACTIVE_LOWERING['start_ts']) <= ts \
+            <= parse_ts(ACTIVE_LOWERING['stop_ts']):
+        return ACTIVE_LOWERING
 
+    lowering = await asyncio.to_thread(getLoweringByEvent,
+                                       event['message']['id'])
+    if lowering:
+        ACTIVE_LOWERING = lowering
+    return lowering
 
-def enable_asnap():
-    logger.info('Turning ASNAP on')
-    setCustomVar(ASNAP_STATUS_VAR_ID, 'On')
 
-def disable_asnap():
-    logger.info('Turning ASNAP off')
-    setCustomVar(ASNAP_STATUS_VAR_ID, 'Off')
+# Keeps the cached lowering in step with changes made through Sealog
+def handle_lowering_change(msg):
+    global ACTIVE_LOWERING
+
+    if ACTIVE_LOWERING is None:
+        return
+
+    lowering = msg.get('message', {})
+    if msg.get('topic') == '/ws/status/updateLowerings' and \
+            lowering.get('id') == ACTIVE_LOWERING['id']:
+        ACTIVE_LOWERING.update(lowering)
+    else:
+        logger.debug('Lowerings changed, forgetting active lowering')
+        ACTIVE_LOWERING = None
 
 
-def stamp_lowering_milestone(milestone, event):
-    lowering = getLoweringByEvent(event['message']['id'])
+async def stamp_lowering_milestone(action, event):
+    milestone = action['milestone']
+    lowering = await get_lowering(event)
     if not lowering:
         logger.warning('Cannot stamp lowering record because there is no '
                        'active lowering')
@@ -86,42 +211,103 @@ def stamp_lowering_milestone(milestone, event):
         }
     elif milestone in ('on_bottom', 'off_bottom'):
         payload = {
-            'lowering_additional_meta': lowering['lowering_additional_meta'],
+            'lowering_additional_meta':
+                copy.deepcopy(lowering['lowering_additional_meta']),
         }
         payload['lowering_additional_meta'].setdefault('milestones', {})\
                [f'lowering_{milestone}'] = event['message']['ts']
-        del payload['lowering_additional_meta']['lowering_files']
+        payload['lowering_additional_meta'].pop('lowering_files', None)
     else:
         raise ValueError('Unexpected milestone')
 
-    requests.patch(
+    r = await asyncio.to_thread(
+        requests.patch,
         f'{apiServerURL}{loweringsAPIPath}/{lowering["lowering_id"]}',
         headers=headers,
         json=payload,
     )
 
+    # Reflect the change in our copy, rather than fetching it again
+    if r.ok:
+        if 'lowering_additional_meta' in payload:
+            lowering['lowering_additional_meta'].setdefault('milestones', {})\
+                .update(payload['lowering_additional_meta']['milestones'])
+        else:
+            lowering.update(payload)
 
-async def handle_event(event):
-    if event['message']['event_value'] != 'VEHICLE':
+
+ACTIONS = {
+    'post_aux_data': post_aux_data,
+    'set_custom_var': set_custom_var,
+    'stamp_lowering_milestone': stamp_lowering_milestone,
+}
+
+
+# Turns a list of rules into a dictionary for constant-time lookup. Any custom
+# variables referenced are resolved up front so that mistakes surface early.
+def compile_rules(rules):
+    compiled = {}
+    for rule in rules:
+        key = (rule['event_value'], rule['option_name'], rule['option_value'])
+        for action in rule['actions']:
+            if action['action'] not in ACTIONS:
+                raise ValueError(f'Unknown action {action["action"]}')
+            if action['action'] == 'stamp_lowering_milestone' and \
+                    action['milestone'] not in ('start', 'stop', 'on_bottom',
+                                                'off_bottom'):
+                raise ValueError(f'Unknown milestone {action["milestone"]}')
+            if action['action'] == 'set_custom_var':
+                resolve_custom_var_id(action['name'])
+
+            compiled.setdefault(key, []).append(
+                functools.partial(ACTIONS[action['action']], action))
+    return compiled
+
+
+# (Re)loads the rules file if it has changed since we last read it. If the new
+# rules are broken, we keep using the old ones.
+def load_rules():
+    global RULES, RULES_MTIME
+
+    if ARGS.rules is None:
+        if RULES_MTIME is None:
+            RULES, RULES_MTIME = compile_rules(DEFAULT_RULES), 0
         return
 
+    mtime = None
+    try:
+        mtime = os.stat(ARGS.rules).st_mtime
+        if mtime == RULES_MTIME:
+            return
+
+        with open(ARGS.rules) as f:
+            RULES = compile_rules(json.load(f))
+        logger.info(f'Loaded {len(RULES)} rules from {ARGS.rules}')
+    except:
+        if RULES_MTIME is None:
+            raise
+        logger.exception(f'Could not reload {ARGS.rules}, keeping old rules')
+
+    # If the file could not even be stat'd (e.g. it is being replaced), try
+    # again on the next event
+    if mtime is not None:
+        RULES_MTIME = mtime
+
+
+async def handle_event(event):
+    await asyncio.to_thread(load_rules)
+
+    event_value = event['message']['event_value']
+    actions = []
     for option in event['message']['event_options']:
-        option_name_val = (option['event_option_name'],
-                           option['event_option_value'])
-        
-        if option_name_val == ('milestone', 'Alvin off deck'):
-            stamp_lowering_milestone('start', event)
-
-        elif option_name_val == ('milestone', 'On bottom'):
-            enable_asnap()
-            stamp_lowering_milestone('on_bottom', event)
-        
-        elif option_name_val == ('milestone', 'Off bottom'):
-            disable_asnap()
-            stamp_lowering_milestone('off_bottom', event)
-        
-        elif option_name_val == ('milestone', 'Alvin on deck'):
-            stamp_lowering_milestone('stop', event)
+        key = (event_value, option['event_option_name'],
+               option['event_option_value'])
+        actions.extend(action(event) for action in RULES.get(key, ()))
+
+    # Run the actions concurrently, but let each one fail on its own
+    for result in await asyncio.gather(*actions, return_exceptions=True):
+        if isinstance(result, Exception):
+            logger.error('An action failed', exc_info=result)
 
 
 async def event_listener():
@@ -135,6 +321,9 @@ async def event_listener():
                 if msg.get('type') == 'ping':
                     logger.debug('Acknowledging ping from server')
                     await websocket.send(json.dumps(PING))
+                elif msg.get('type') == 'pub' and \
+                        msg.get('topic', '').endswith('Lowerings'):
+                    handle_lowering_change(msg)
                 elif msg.get('type') == 'pub':
                     await handle_event(msg)
                 else:
@@ -148,10 +337,19 @@ async def event_listener():
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('--rules', metavar='FILE',
+                        help='JSON file of rules to use instead of the '
+                             'built-in Alvin milestones')
+    ARGS = parser.parse_args()
+
     try:
-        init_asnap_status_var_id()
+        load_rules()
     except:
-        logger.exception('Could not resolve asnapStatus variable ID')
+        logger.exception('Could not load rules')
         quit()
 
     asyncio.run(event_listener())
@@ -14,15 +14,22 @@ import argparse
 import asyncio
 import collections
 import datetime
+import hashlib
 import json
 import logging
 import os
+import re
+import shutil
+import time
 import urllib.parse
 
+import aiohttp
 import requests
 import socketio
 import websockets
 
+import python_sealog.lowerings
+from python_sealog.lowerings import getLoweringByEvent
 from python_sealog.settings import apiServerURL, eventAuxDataAPIPath, headers, \
                                    wsServerURL
 
@@ -49,24 +56,420 @@ PING = {
 ARGS = None
 
 # Incoming Sealog events get added to this queue and processed by a worker
-Event = collections.namedtuple('Event', 'id timestamp frames')
+Event = collections.namedtuple('Event',
+                               'id timestamp value grabbers frames digests')
 EVENT_QUEUE = None  # see https://stackoverflow.com/a/55918049/145504
 
+# A frame that did not fit in the queue's memory budget and was parked on disk
+SpooledFrame = collections.namedtuple('SpooledFrame', 'path size')
+
+# Events with this value may be dropped when the queue overflows
+ASNAP_EVENT_VALUE = 'ASNAP'
+
+# Maps each camera to the content hash, path relative to --dest and event
+# timestamp of the last frame stored from it, so that a repeated frame (e.g.
+# from a frozen feed) can be hardlinked rather than written again.
+LAST_FRAMES = {}
+
+# Held while LAST_FRAMES is updated and saved, as several workers finish events
+# at once
+LAST_FRAMES_LOCK = None
+
+# The framegrabbers we currently know about, keyed by URL
+GRABBERS = {}
+
+# Number of recent download times used to adapt a grabber's timeout
+LATENCY_SAMPLES = 50
+
+# The lowering that the most recent event belonged to, and when we looked it up
+ACTIVE_LOWERING = None
+ACTIVE_LOWERING_FETCHED = None
+ACTIVE_LOWERING_LOCK = None
+
+# Directory used by the lowering layout for events outside of any lowering
+NO_LOWERING_DIR = 'no-lowering'
+
+# Shared HTTP session used for posting aux data back to Sealog
+HTTP_SESSION = None
+
 # Records the last heartbeat timestamp from the imaging control server
 LAST_HEARTBEAT = None
 
+# Notified by the imaging control listener whenever a heartbeat arrives
+HEARTBEAT_CONDITION = None
+
+# How long an event waits for an imaging control heartbeat before it is
+# processed with whatever grabber labels we already have.
+HEARTBEAT_TIMEOUT = datetime.timedelta(seconds=3)
+
 
-def download_url(url):
+def spool_frame(path, frame):
+    with open(path, 'wb') as f:
+        f.write(frame)
+    return SpooledFrame(path=path, size=len(frame))
+
+
+def discard_frames(frames):
+    for frame in frames:
+        if isinstance(frame, SpooledFrame):
+            try:
+                os.unlink(frame.path)
+            except FileNotFoundError:
+                pass
+
+
+# A queue of events that keeps at most max_bytes worth of frames in memory;
+# frames beyond that are spilled to spool_dir until a worker writes them out.
+#
+# At most max_events may be waiting at once. When that limit is hit, the
+# 'block' overflow policy makes put() wait for a worker to catch up, while
+# 'drop-asnap' discards the oldest queued ASNAP event (or the incoming one if
+# it is itself an ASNAP). Events created by users are never dropped.
+class EventQueue:
+    def __init__(self, max_bytes, max_events, overflow, spool_dir):
+        self.max_bytes = max_bytes
+        self.max_events = max_events
+        self.overflow = overflow
+        self.spool_dir = spool_dir
+
+        self.events = collections.deque()
+        self.condition = asyncio.Condition()
+        self.unfinished = 0
+
+        # Frames held by queued or in-progress events
+        self.memory_bytes = 0
+        self.spooled_bytes = 0
+        self.dropped = 0
+
+    def qsize(self):
+        return len(self.events)
+
+    def _release(self, event):
+        for frame in event.frames:
+            if isinstance(frame, SpooledFrame):
+                self.spooled_bytes -= frame.size
+            elif frame is not None:
+                self.memory_bytes -= len(frame)
+
+    async def _drop(self, event):
+        logger.warning('Event queue is full, dropping %s event %s',
+                       event.value, event.id)
+        self.dropped += 1
+        await asyncio.to_thread(discard_frames, event.frames)
+
+    async def put(self, event):
+        async with self.condition:
+            while len(self.events) >= self.max_events:
+                if self.overflow == 'block':
+                    await self.condition.wait()
+                    continue
+
+                victim = next((e for e in self.events
+                               if e.value == ASNAP_EVENT_VALUE), None)
+                if victim is not None:
+                    self.events.remove(victim)
+                    self.unfinished -= 1
+                    self._release(victim)
+                    await self._drop(victim)
+                elif event.value == ASNAP_EVENT_VALUE:
+                    await self._drop(event)
+                    return
+                else:
+                    break
+
+            # Keep as many frames in memory as the budget allows and spill the
+            # rest to disk.
+            frames, spilled = list(event.frames), []
+            for i, frame in enumerate(frames):
+                if frame is None:
+                    continue
+                if self.memory_bytes + len(frame) <= self.max_bytes:
+                    self.memory_bytes += len(frame)
+                else:
+                    spilled.append(i)
+
+            if spilled:
+                logger.info('Spooling %d frames of event %s to disk',
+                            len(spilled), event.id)
+                spooled = await asyncio.gather(*(
+                    asyncio.to_thread(spool_frame, os.path.join(
+                        self.spool_dir, f'{event.id}.{i}'), frames[i])
+                    for i in spilled
+                ))
+                for i, frame in zip(spilled, spooled):
+                    frames[i] = frame
+                    self.spooled_bytes += frame.size
+
+            self.events.append(event._replace(frames=frames))
+            self.unfinished += 1
+            self.condition.notify_all()
+
+    async def get(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.events)
+            event = self.events.popleft()
+            self.condition.notify_all()
+            return event
+
+    def task_done(self, event):
+        self._release(event)
+        self.unfinished -= 1
+
+
+# Downloads a frame, hashing it as it arrives. Returns the frame and its digest.
+def download_url(session, url, timeout):
     logger.info('Downloading frame from %s', url)
     data = bytearray()
-    with requests.get(url, stream=True, timeout=ARGS.timeout) as r:
+    digest = hashlib.blake2b(digest_size=16)
+    with session.get(url, stream=True, timeout=timeout) as r:
         r.raise_for_status()
         for chunk in r.iter_content(chunk_size=8192):
             data += chunk
-    return data
+            digest.update(chunk)
+    return data, digest.hexdigest()
+
+
+# A framegrabber, along with the state we keep for it across heartbeats: a
+# persistent HTTP session and its recent download times and failures.
+#
+# The timeout for a grabber adapts to how quickly it has been answering. After
+# repeated failures its circuit opens: events skip the grabber entirely while a
+# background task probes it until it responds again.
+class Grabber:
+    def __init__(self, label, url, pattern, camera):
+        self.label = label
+        self.url = url
+        self.pattern = pattern
+        self.camera = camera
+        self.session = requests.Session()
+        self.latencies = collections.deque(maxlen=LATENCY_SAMPLES)
+        self.failures = 0
+        self.probe = None
+
+    def close(self):
+        if self.probe is not None:
+            self.probe.cancel()
+        self.session.close()
+
+    def is_open(self):
+        return self.probe is not None
+
+    def timeout(self):
+        if len(self.latencies) < 5:
+            return ARGS.timeout
+        latencies = sorted(self.latencies)
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        return min(max(p95 * ARGS.timeout_multiplier, ARGS.min_timeout),
+                   ARGS.timeout)
+
+    def record_success(self, latency):
+        self.latencies.append(latency)
+        self.failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= ARGS.failure_threshold and not self.is_open():
+            logger.warning('Framegrabber %s failed %d times, skipping it until '
+                           'it recovers', self.url, self.failures)
+            self.probe = asyncio.create_task(self.probe_until_healthy())
+
+    async def probe_until_healthy(self):
+        while True:
+            await asyncio.sleep(ARGS.probe_interval)
+            try:
+                start = time.monotonic()
+                await asyncio.wait_for(
+                    asyncio.to_thread(download_url, self.session, self.url,
+                                      ARGS.timeout),
+                    ARGS.timeout)
+            except Exception:
+                logger.debug('Framegrabber %s is still unhealthy', self.url)
+                continue
+
+            logger.info('Framegrabber %s has recovered', self.url)
+            self.latencies.clear()
+            self.record_success(time.monotonic() - start)
+            self.probe = None
+            return
+
+
+# Downloads a frame from a grabber unless it is known to be unhealthy. Returns
+# the frame and its digest, or None if the grabber was skipped.
+async def grab_frame(grabber):
+    if grabber.is_open():
+        return None
+
+    timeout = grabber.timeout()
+    start = time.monotonic()
+    try:
+        result = await asyncio.wait_for(
+            asyncio.to_thread(download_url, grabber.session, grabber.url,
+                              timeout),
+            timeout)
+    except Exception:
+        grabber.record_failure()
+        raise
+
+    grabber.record_success(time.monotonic() - start)
+    return result
+
+
+# Brings the grabber registry in line with a list of (label, url, pattern,
+# camera) tuples. Grabbers whose URL is unchanged are updated in place so that
+# their state survives.
+def update_grabbers(specs):
+    current = [(g.label, g.url, g.pattern, g.camera) for g in GRABBERS.values()]
+    if current == specs:
+        return
+
+    logger.info('Framegrabber configuration changed')
+    grabbers = {}
+    for label, url, pattern, camera in specs:
+        grabber = GRABBERS.pop(url, None)
+        if grabber is None:
+            grabber = Grabber(label, url, pattern, camera)
+        grabber.label, grabber.pattern, grabber.camera = label, pattern, camera
+        grabbers[url] = grabber
+
+    for grabber in GRABBERS.values():
+        grabber.close()
+
+    GRABBERS.clear()
+    GRABBERS.update(grabbers)
+
+
+def parse_ts(ts):
+    return datetime.datetime.fromisoformat(ts.replace('Z', '+00:00'))\
+                            .replace(tzinfo=None)
+
+
+# Finds the lowering an event belongs to. The last lowering found is reused for
+# events that fall within its start and stop times, and is refreshed once it is
+# older than --lowering-cache-ttl. Events outside any lowering, and lookups that
+# fail, are not cached, so that the next event asks again. A failed lookup is
+# treated as no lowering, so the event's frames are still stored.
+async def get_active_lowering(event):
+    global ACTIVE_LOWERING, ACTIVE_LOWERING_FETCHED
+
+    async with ACTIVE_LOWERING_LOCK:
+        if ACTIVE_LOWERING_FETCHED is not None and \
+                time.monotonic() - ACTIVE_LOWERING_FETCHED < \
+                ARGS.lowering_cache_ttl and \
+                parse_ts(ACTIVE_LOWERING['start_ts']) <= event.timestamp < \
+                parse_ts(ACTIVE_LOWERING['stop_ts']):
+            return ACTIVE_LOWERING
+
+        ACTIVE_LOWERING = None
+        ACTIVE_LOWERING_FETCHED = None
+
+        try:
+            lowering = await asyncio.to_thread(getLoweringByEvent, event.id)
+            # The API answers errors with JSON too, so check this is a lowering
+            if lowering is not None and (
+                    not isinstance(lowering, dict) or
+                    'lowering_id' not in lowering or
+                    parse_ts(lowering['start_ts']) >
+                    parse_ts(lowering['stop_ts'])):
+                raise ValueError(f'Unexpected reply: {lowering}')
+        except Exception:
+            logger.warning('Could not look up the lowering for event %s',
+                           event.id, exc_info=True)
+            return None
+
+        if lowering is not None:
+            logger.info('Event %s belongs to lowering %s', event.id,
+                        lowering['lowering_id'])
+            ACTIVE_LOWERING = lowering
+            ACTIVE_LOWERING_FETCHED = time.monotonic()
+        return lowering
+
+
+# Returns the directory, relative to --dest, that an event's frame from the
+# given camera is stored in.
+def frame_dir(event, lowering, camera):
+    if ARGS.layout == 'flat':
+        return ''
+
+    return os.path.join(
+        lowering['lowering_id'] if lowering else NO_LOWERING_DIR,
+        re.sub(r'[^\w.-]+', '_', camera),
+        event.timestamp.strftime('%Y%m%d_%H'),
+    )
 
 
-def attach_framegrabs(event, grabs):
+# The index holds one "camera<TAB>digest<TAB>path<TAB>timestamp" line per
+# camera. Lines in any other format, such as those of older indexes, are
+# ignored and dropped the next time the index is saved.
+def load_frame_index(path):
+    try:
+        with open(path) as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) != 4:
+                    continue
+                camera, digest, name, ts = fields
+                try:
+                    ts = datetime.datetime.fromisoformat(ts)
+                except ValueError:
+                    continue
+                LAST_FRAMES[camera] = (digest, name, ts)
+    except FileNotFoundError:
+        pass
+    logger.info('Loaded last frames for %d cameras', len(LAST_FRAMES))
+
+
+def save_frame_index(path, entries):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        for camera, (digest, name, ts) in entries.items():
+            f.write(f'{camera}\t{digest}\t{name}\t{ts.isoformat()}\n')
+    os.replace(tmp_path, path)
+
+
+# Writes a frame to disk. This blocks, so it is run on a worker thread.
+#
+# If the frame is identical to the last one stored from the same camera, the
+# new file is created as a hardlink to it instead. Returns True if the frame's
+# contents were written.
+def write_frame(out_path, frame, digest, camera):
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+
+    last = LAST_FRAMES.get(camera) if ARGS.dedup else None
+    existing = last[1] if last and last[0] == digest else None
+    if existing is not None:
+        try:
+            os.link(os.path.join(ARGS.dest, existing), out_path)
+        except OSError:
+            pass  # e.g. the original was removed; just write it out again
+        else:
+            discard_frames([frame])
+            return False
+
+    if isinstance(frame, SpooledFrame):
+        shutil.move(frame.path, out_path)
+        if ARGS.fsync != 'none':
+            with open(out_path, 'rb') as f:
+                os.fsync(f.fileno())
+        return True
+
+    with open(out_path, 'wb') as f:
+        f.write(frame)
+        if ARGS.fsync != 'none':
+            f.flush()
+            os.fsync(f.fileno())
+    return True
+
+
+# Makes the directory entries for newly written files durable
+def fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+async def attach_framegrabs(event, grabs):
     aux_data = {
         'event_id': event.id,
         'data_source': 'vehicleRealtimeFramegrabberData',
@@ -86,11 +489,14 @@ def attach_framegrabs(event, grabs):
 
     # Post the new auxiliary data
     logger.info('Associating grabbed frames with event %s', event.id)
-    requests.post(
+    async with HTTP_SESSION.post(
         f'{apiServerURL}{eventAuxDataAPIPath}',
         headers=headers,
         json=aux_data,
-    )
+    ) as r:
+        if r.status >= 400:
+            logger.error('Could not attach frames to event %s: %s',
+                         event.id, await r.text())
 
 
 # Handle an incoming Sealog events by contacting all known framegrabbers and
@@ -102,65 +508,159 @@ async def handle_event(event):
          logger.info('Ignoring event older than maximum age')
          return
 
-    # Download an image from each framegrabber to memory
+    # Download an image from each healthy framegrabber to memory
+    grabbers = list(GRABBERS.values())
+    if not grabbers:
+        logger.warning('No framegrabbers are configured')
+        return
+
     frames = await asyncio.gather(*(
-        asyncio.to_thread(download_url, url)
-        for _, url, _ in ARGS.grabbers
+        grab_frame(grabber)
+        for grabber in grabbers
     ), return_exceptions=True)
 
-    frames = [None if isinstance(f, Exception) else f for f in frames]
+    frames, digests = zip(*(
+        (None, None) if f is None or isinstance(f, Exception) else f
+        for f in frames
+    ))
     if not any(frames):
         logger.warn('Could not contact any framegrabbers')
         return
 
     # Enqueue event for future processing
-    EVENT_QUEUE.put_nowait(Event(
+    await EVENT_QUEUE.put(Event(
         id=event['message']['id'],
         timestamp=ts,
+        value=event['message']['event_value'],
+        grabbers=grabbers,
         frames=frames,
+        digests=digests,
     ))
 
 
-# This worker pops events with frames off the queue, and submits them to
-# Sealog with the appropriate camera labels attached.
-async def auxdata_worker():
-    while True:
-        event = await EVENT_QUEUE.get()
-        logger.info('Worker popped event %s', event.id)
-
-        # If there hasn't been an imaging control heartbeat since this event
-        # was received, place it back in the queue.
-        if ARGS.imaging_control is not None:
-            dt = None if LAST_HEARTBEAT is None else \
-                 (event.timestamp - LAST_HEARTBEAT).total_seconds()
-            if dt is not None and dt >= 3:
-                logger.info('No heartbeat, doing event %s anyway', event.id)
-            elif dt is None or dt >= 0:
-                logger.info('Re-queuing event %s until heartbeat', event.id)
-                EVENT_QUEUE.put_nowait(event)
-                EVENT_QUEUE.task_done()
-                await asyncio.sleep(0.5)
-                continue
+# Waits until an imaging control heartbeat has arrived after the event was
+# created, so that we know the grabber labels that were in effect. Each event
+# gives up once its own deadline has passed.
+async def wait_for_heartbeat(event):
+    def heartbeat_covers_event():
+        return LAST_HEARTBEAT is not None and LAST_HEARTBEAT > event.timestamp
+
+    async with HEARTBEAT_CONDITION:
+        if heartbeat_covers_event():
+            return
+
+        # If the imaging control server had already gone quiet before this
+        # event, there is no point in waiting for it.
+        if LAST_HEARTBEAT is not None and \
+                event.timestamp - LAST_HEARTBEAT >= HEARTBEAT_TIMEOUT:
+            logger.info('No heartbeat, doing event %s anyway', event.id)
+            return
+
+        deadline = event.timestamp + HEARTBEAT_TIMEOUT
+        remaining = (deadline - datetime.datetime.utcnow()).total_seconds()
+        logger.info('Holding event %s until heartbeat', event.id)
+        try:
+            await asyncio.wait_for(
+                HEARTBEAT_CONDITION.wait_for(heartbeat_covers_event),
+                timeout=max(remaining, 0),
+            )
+        except asyncio.TimeoutError:
+            logger.info('No heartbeat, doing event %s anyway', event.id)
+
+
+# Records the frames just written as the last ones from their cameras, unless
+# a worker has already recorded a later event, and saves the index. A failed
+# save is only logged, as the frames are on disk either way.
+async def update_frame_index(event, writes):
+    async with LAST_FRAMES_LOCK:
+        changed = False
+        for camera, digest, out_name, _ in writes:
+            last = LAST_FRAMES.get(camera)
+            if last is None or last[2] < event.timestamp:
+                LAST_FRAMES[camera] = (digest, out_name, event.timestamp)
+                changed = True
+        if not changed:
+            return
+
+        try:
+            await asyncio.to_thread(save_frame_index, ARGS.dedup_index,
+                                    dict(LAST_FRAMES))
+        except Exception:
+            logger.exception('Could not save the frame index')
+
+
+# Writes the frames of an event to disk and attaches them to the original
+# Sealog event.
+async def process_event(event):
+    if ARGS.imaging_control is not None:
+        await wait_for_heartbeat(event)
+
+    # Now that we finally know labels for the grabbers, write frames to
+    # disk and attach them to the original Sealog event.
+    lowering = None
+    if ARGS.layout == 'lowering':
+        lowering = await get_active_lowering(event)
+
+    grabs = []
+    writes = []
+    for grabber, frame, digest in zip(event.grabbers, event.frames,
+                                      event.digests):
+        if frame is None:
+            continue
+        label, pattern = grabber.label, grabber.pattern
+
+        out_name = os.path.join(
+            frame_dir(event, lowering, grabber.camera),
+            pattern.replace('{}',
+                event.timestamp.strftime('%Y%m%d_%H%M%S%f')[:-3]),
+        )
+        out_path = os.path.join(ARGS.dest, out_name)
+        grabs.append((label, out_name))
+        writes.append((grabber.camera, digest, out_name, asyncio.to_thread(
+            write_frame, out_path, frame, digest, grabber.camera)))
 
-        # Now that we finally know labels for the grabbers, write frames to
-        # disk and attach them to the original Sealog event.
-        grabs = []
-        for grabber, frame in zip(ARGS.grabbers, event.frames):
-            if frame is None:
-                continue
-            label, _, pattern = grabber
+    await asyncio.gather(*(w for _, _, _, w in writes))
+    if ARGS.dedup and writes:
+        await update_frame_index(event, writes)
 
-            out_name = pattern.replace('{}',
-                event.timestamp.strftime('%Y%m%d_%H%M%S%f')[:-3])
-            out_path = os.path.join(ARGS.dest, out_name)
-            grabs.append((label, out_name))
+    if ARGS.fsync == 'dir':
+        for out_dir in {os.path.dirname(out_name) for _, out_name in grabs}:
+            await asyncio.to_thread(fsync_dir,
+                                    os.path.join(ARGS.dest, out_dir))
 
-            with open(out_path, 'wb') as f:
-                f.write(frame)
+    await attach_framegrabs(event, grabs)
 
-        attach_framegrabs(event, grabs)
 
-        EVENT_QUEUE.task_done()
+# This worker pops events with frames off the queue, and submits them to
+# Sealog with the appropriate camera labels attached. Several of these run
+# concurrently so that a slow disk or API does not hold up other events.
+async def auxdata_worker(n):
+    while True:
+        event = await EVENT_QUEUE.get()
+        logger.info('Worker %d popped event %s', n, event.id)
+
+        try:
+            await process_event(event)
+        except:
+            logger.exception('An exception occurred while processing event %s',
+                             event.id)
+        finally:
+            # Clean up any spooled frames that did not make it to --dest
+            if any(isinstance(f, SpooledFrame) for f in event.frames):
+                await asyncio.to_thread(discard_frames, event.frames)
+            EVENT_QUEUE.task_done(event)
+
+
+# Periodically reports how much work is waiting in the event queue
+async def queue_reporter():
+    while True:
+        await asyncio.sleep(ARGS.stats_interval)
+        logger.info('Event queue: %d waiting, %d in progress, %d bytes in '
+                    'memory, %d bytes spooled, %d dropped',
+                    EVENT_QUEUE.qsize(),
+                    EVENT_QUEUE.unfinished - EVENT_QUEUE.qsize(),
+                    EVENT_QUEUE.memory_bytes, EVENT_QUEUE.spooled_bytes,
+                    EVENT_QUEUE.dropped)
 
 
 # Listens for new events coming from Sealog
@@ -207,13 +707,19 @@ async def imaging_control_listener():
         global LAST_HEARTBEAT
         LAST_HEARTBEAT = datetime.datetime.utcnow()
 
-        ARGS.grabbers = []
-        for i, grabber_info in enumerate(hb.get('framegrabbers', [])):
-            ARGS.grabbers.append((
+        update_grabbers([
+            (
                 f'{grabber_info["camera_name"]} (Framegrabber {i+1})',
                 grabber_info['url'],
                 f'{{}}.{grabber_info["camera_name"]}.framegrab{i+1:02}.jpg',
-            ))
+                grabber_info['camera_name'],
+            )
+            for i, grabber_info in enumerate(hb.get('framegrabbers', []))
+        ])
+
+        # Release any events that were waiting on this heartbeat
+        async with HEARTBEAT_CONDITION:
+            HEARTBEAT_CONDITION.notify_all()
 
     await sio.connect(f'{u.scheme}://{u.netloc}',
                       socketio_path=f'{u.path}/socket.io',
@@ -224,10 +730,55 @@ async def imaging_control_listener():
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument('--dest', required=True)
+    parser.add_argument('--api-url', default=apiServerURL,
+                        help='Sealog API server URL')
+    parser.add_argument('--ws-url', default=wsServerURL,
+                        help='Sealog websocket server URL')
     parser.add_argument('--max-age', type=int, default=10,
                         help='Maximum age of an event that will be annotated')
     parser.add_argument('--timeout', type=float, default=1.0,
                         help='Maximum amount of time to wait for a grabber')
+    parser.add_argument('--min-timeout', type=float, default=0.2,
+                        help='Minimum amount of time to wait for a grabber')
+    parser.add_argument('--timeout-multiplier', type=float, default=3.0,
+                        help='Wait this many times longer than the 95th '
+                             'percentile of a grabber\'s recent downloads')
+    parser.add_argument('--failure-threshold', type=int, default=3,
+                        help='Skip a grabber after this many failures in a row')
+    parser.add_argument('--probe-interval', type=float, default=5.0,
+                        help='Seconds between attempts to contact a grabber '
+                             'that is being skipped')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='Number of events to write and attach at once')
+    parser.add_argument('--fsync', choices=('none', 'file', 'dir'),
+                        default='none',
+                        help='Flush each frame (file) and also the directory '
+                             'entry (dir) to disk before attaching it')
+    parser.add_argument('--queue-max-bytes', type=int, default=256*1024*1024,
+                        help='Bytes of queued frames to hold in memory before '
+                             'spilling them to disk')
+    parser.add_argument('--queue-max-events', type=int, default=1000,
+                        help='Maximum number of events waiting to be written')
+    parser.add_argument('--overflow', choices=('drop-asnap', 'block'),
+                        default='drop-asnap',
+                        help='What to do when the event queue is full')
+    parser.add_argument('--spool-dir',
+                        help='Where to spill queued frames (default: '
+                             'DEST/.spool)')
+    parser.add_argument('--no-dedup', dest='dedup', action='store_false',
+                        help='Always write frames, even if identical to the '
+                             'last one from the same camera')
+    parser.add_argument('--dedup-index',
+                        help='File recording the last frame stored from each '
+                             'camera (default: DEST/.framegrab-index)')
+    parser.add_argument('--layout', choices=('flat', 'lowering'),
+                        default='flat',
+                        help='Write frames directly into DEST (flat), or into '
+                             'DEST/LOWERING/CAMERA/YYYYMMDD_HH (lowering)')
+    parser.add_argument('--lowering-cache-ttl', type=float, default=60,
+                        help='Seconds to trust the last active lowering lookup')
+    parser.add_argument('--stats-interval', type=float, default=60,
+                        help='Seconds between event queue reports')
     group = parser.add_mutually_exclusive_group()
     group.add_argument('--grabber', nargs=3, action='append', dest='grabbers',
                        metavar=('LABEL', 'URL', 'FILENAME_PATTERN'))
@@ -235,14 +786,43 @@ if __name__ == '__main__':
 
     ARGS = parser.parse_args()
 
-    async def start():
-        global EVENT_QUEUE
-        EVENT_QUEUE = asyncio.Queue()
+    # Override the python_sealog settings, e.g. to point at a test server
+    apiServerURL, wsServerURL = ARGS.api_url, ARGS.ws_url
+    python_sealog.lowerings.apiServerURL = apiServerURL
+
+    if ARGS.spool_dir is None:
+        ARGS.spool_dir = os.path.join(ARGS.dest, '.spool')
+    os.makedirs(ARGS.spool_dir, exist_ok=True)
+
+    if ARGS.dedup_index is None:
+        ARGS.dedup_index = os.path.join(ARGS.dest, '.framegrab-index')
+    if ARGS.dedup:
+        load_frame_index(ARGS.dedup_index)
 
-        await asyncio.gather(
-            event_listener(),
-            imaging_control_listener(),
-            auxdata_worker(),
+    update_grabbers([
+        (label, url, pattern, label)
+        for label, url, pattern in ARGS.grabbers or []
+    ])
+
+    async def start():
+        global EVENT_QUEUE, HEARTBEAT_CONDITION, HTTP_SESSION, \
+               ACTIVE_LOWERING_LOCK, LAST_FRAMES_LOCK
+        EVENT_QUEUE = EventQueue(
+            max_bytes=ARGS.queue_max_bytes,
+            max_events=ARGS.queue_max_events,
+            overflow=ARGS.overflow,
+            spool_dir=ARGS.spool_dir,
         )
+        HEARTBEAT_CONDITION = asyncio.Condition()
+        ACTIVE_LOWERING_LOCK = asyncio.Lock()
+        LAST_FRAMES_LOCK = asyncio.Lock()
+
+        async with aiohttp.ClientSession() as HTTP_SESSION:
+            await asyncio.gather(
+                event_listener(),
+                imaging_control_listener(),
+                queue_reporter(),
+                *(auxdata_worker(n) for n in range(ARGS.workers)),
+            )
 
     asyncio.run(start())
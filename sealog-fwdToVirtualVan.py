@@ -7,11 +7,12 @@
 
 import argparse
 import asyncio
+import collections
 import datetime
 import json
 import logging
 import re
-import socket
+import urllib.error
 import urllib.request
 
 import websockets
@@ -27,17 +28,25 @@ parser = argparse.ArgumentParser(
 )
 parser.add_argument('--time-limit', default=120,
                     help='Discard events from more than this many seconds ago')
-parser.add_argument('--virtualvan', default='198.17.154.221:10502',
-                    help='Address of the VirtualVan DAQ server')
+parser.add_argument('--virtualvan', nargs='+',
+                    default=['198.17.154.221:10502'],
+                    help='Addresses of the VirtualVan DAQ server(s); each '
+                         'one receives every event')
+parser.add_argument('--stats-interval', type=float, default=3600,
+                    help='Seconds between reports of events sent')
+parser.add_argument('--template-refresh', type=float, default=300,
+                    help='Seconds between checks for changed event templates')
 args = parser.parse_args()
 
 
-# Convert the VirtualVan address to a (host, port) tuple
-if ':' in args.virtualvan:
-    host, _, port = args.virtualvan.partition(':')
-    args.virtualvan = (host, int(port))
-else:
-    args.virtualvan = (args.virtualvan, 10502)
+# Convert the VirtualVan addresses to (host, port) tuples
+def parse_address(address):
+    if ':' in address:
+        host, _, port = address.partition(':')
+        return (host, int(port))
+    return (address, 10502)
+
+args.virtualvan = [parse_address(address) for address in args.virtualvan]
 
 
 EXCLUDE_SET = {'ASNAP'}
@@ -45,12 +54,19 @@ EXCLUDE_SET = {'ASNAP'}
 
 CLIENT_WSID = 'sealog2VirtualVan'
 
+# Sealog publishes to these topics when event templates are changed
+TEMPLATE_TOPICS = {
+    '/ws/status/newEventTemplates',
+    '/ws/status/updateEventTemplates',
+    '/ws/status/deleteEventTemplates',
+}
+
 HELLO = {
     'type': 'hello',
     'id': CLIENT_WSID,
     'auth': {'headers': headers},
     'version': '2',
-    'subs': ['/ws/status/newEvents'],
+    'subs': ['/ws/status/newEvents', *TEMPLATE_TOPICS],
 }
 
 PING = {
@@ -80,24 +96,128 @@ ch.setFormatter(formatter)
 logger.addHandler(ch)
 
 
-event_templates = {}
+# What we need to know about an event template to decide whether to forward an
+# event, and what to call it when we do.
+TemplateValidator = collections.namedtuple(
+    'TemplateValidator', 'required_options free_text_required event_name')
+
+
+def compile_template(event_value, template):
+    return TemplateValidator(
+        # The event template option names are normalized when they appear in
+        # an event
+        required_options=frozenset(
+            re.sub(r'\s+', '_', eto['event_option_name'].lower())
+            for eto in template.get('event_options', [])
+            if eto['event_option_required']
+        ),
+        free_text_required=template['event_free_text_required'],
+        event_name='TXT' if event_value == 'FREE_FORM' else event_value,
+    )
+
+
+# Validators for each event template, keyed by event value. These are kept in
+# memory and rebuilt whenever Sealog tells us that a template has changed.
+event_validators = {}
+event_templates_etag = None
+
+# One of these is connected to each VirtualVan address at startup
+DESTINATIONS = []
 
 def get_event_templates():
+    global event_validators, event_templates_etag
+
     req = urllib.request.Request(
         f'{apiServerURL}{eventTemplatesAPIPath}',
         headers=headers
     )
-    with urllib.request.urlopen(req) as r:
-        j = json.loads(r.read().decode())
 
+    # Skip the download if the server can tell us nothing has changed
+    if event_templates_etag:
+        req.add_header('If-None-Match', event_templates_etag)
+
+    try:
+        with urllib.request.urlopen(req) as r:
+            j = json.loads(r.read().decode())
+            etag = r.headers.get('ETag')
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            logger.debug('Event templates have not changed')
+            return
+        raise
+
+    templates = {}
     for template in j:
-        event_templates[template['event_value']] = template
+        templates[template['event_value']] = template
 
     # Put in a bogus event template for free form events
-    event_templates['FREE_FORM'] = {
+    templates['FREE_FORM'] = {
         'event_free_text_required': True
     }
 
+    event_validators = {
+        event_value: compile_template(event_value, template)
+        for event_value, template in templates.items()
+    }
+    event_templates_etag = etag
+    logger.debug('Loaded %d event templates', len(j))
+
+
+async def refresh_event_templates():
+    try:
+        await asyncio.to_thread(get_event_templates)
+    except:
+        logger.exception('Could not refresh event templates')
+
+
+# Periodically revalidate the templates in case a change notification was
+# missed, e.g. while the websocket was reconnecting.
+async def template_refresher():
+    while True:
+        await asyncio.sleep(args.template_refresh)
+        await refresh_event_templates()
+
+
+# Sends datagrams to a single VirtualVan address and counts what happened
+class VirtualVanProtocol(asyncio.DatagramProtocol):
+    def __init__(self, address):
+        self.address = address
+        self.transport = None
+        self.sent = 0
+        self.errors = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def error_received(self, exc):
+        self.errors += 1
+        logger.warning('Error sending to %s:%d: %s', *self.address, exc)
+
+    def send(self, data):
+        try:
+            self.transport.sendto(data)
+            self.sent += 1
+        except OSError as e:
+            self.error_received(e)
+
+
+async def open_destinations():
+    loop = asyncio.get_running_loop()
+    for address in args.virtualvan:
+        _, protocol = await loop.create_datagram_endpoint(
+            lambda: VirtualVanProtocol(address),
+            remote_addr=address,
+        )
+        DESTINATIONS.append(protocol)
+
+
+async def stats_reporter():
+    while True:
+        await asyncio.sleep(args.stats_interval)
+        for d in DESTINATIONS:
+            logger.info('Sent %d events to %s:%d (%d errors)',
+                        d.sent, *d.address, d.errors)
+
 
 async def handle_event(event):
     event_value = event['message']['event_value']
@@ -106,33 +226,25 @@ async def handle_event(event):
         logger.debug('Skipping because event value is in the exclude set')
         return
 
-    # Because event templates can change, we do not cache the result of this
-    # API call, but it makes us a little sad
-    get_event_templates()
-    event_template = event_templates[event_value]
+    # A template we have not seen may have been created just now
+    if event_value not in event_validators:
+        await refresh_event_templates()
+    validator = event_validators[event_value]
 
-    req_free_text = event_template['event_free_text_required']
-    if req_free_text and not event['message'].get('event_free_text'):
+    if validator.free_text_required and \
+            not event['message'].get('event_free_text'):
         logger.debug('Ignoring event because required free text is missing')
         return
 
-    for eto in event_template.get('event_options', []):
-        eto_name = eto['event_option_name']
-        eto_required = eto['event_option_required']
-        if not eto_required:
-            continue
-
-        # The event template option names are normalized when they appear in an event
-        eto_name = re.sub('\s+', '_', eto_name.lower())
-
-        for opt in event['message']['event_options']:
-            opt_name = opt['event_option_name']
-            opt_value = opt['event_option_value']
-            if opt_name == eto_name and opt_value:
-                break
-        else:
-            logger.debug('Ignoring event because required field %s is missing', eto_name)
-            return
+    missing = validator.required_options.difference(
+        opt['event_option_name']
+        for opt in event['message']['event_options']
+        if opt['event_option_value']
+    )
+    if missing:
+        logger.debug('Ignoring event because required fields %s are missing',
+                     ', '.join(sorted(missing)))
+        return
 
     # Requires Python 3.7. We need to explicitly expand the timezone
     timestamp = datetime.datetime.fromisoformat(
@@ -143,9 +255,7 @@ async def handle_event(event):
         logger.debug('Ignored because the user took too long to submit')
         return
 
-    event_name = 'TXT'
-    if event_value != 'FREE_FORM':
-        event_name = event_value
+    event_name = validator.event_name
 
     event_options = ''
     if len(event['message']['event_options']) > 0:
@@ -163,8 +273,9 @@ async def handle_event(event):
     ])
 
     logger.debug('Adding Record: ' + line)
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.sendto(line.encode(), args.virtualvan)
+    data = line.encode()
+    for destination in DESTINATIONS:
+        destination.send(data)
 
 
 async def event_listener():
@@ -178,6 +289,10 @@ async def event_listener():
                 if msg.get('type') == 'ping':
                     logger.debug('Acknowledging ping from server')
                     await websocket.send(json.dumps(PING))
+                elif msg.get('type') == 'pub' and \
+                        msg.get('topic') in TEMPLATE_TOPICS:
+                    logger.debug('Event templates changed, refreshing')
+                    await refresh_event_templates()
                 elif msg.get('type') == 'pub':
                     await handle_event(msg)
                 else:
@@ -195,7 +310,13 @@ async def main():
     # event arrives.
     get_event_templates()
 
-    await event_listener()
+    await open_destinations()
+
+    await asyncio.gather(
+        event_listener(),
+        template_refresher(),
+        stats_reporter(),
+    )
 
 
 if __name__ == '__main__':
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+'''
+This service keeps an index of Sealog's lowerings and cruises in memory and
+answers "which lowering and cruise does this time belong to?" over a Unix
+domain socket, so that acquisition scripts can name their files without
+paying for a Python startup and an API round trip every time.
+
+Each query is a line holding an ISO 8601 timestamp or a filename containing
+one, and each answer is a line holding the lowering and cruise IDs separated
+by a tab, with null where there is no match. A connection can carry any
+number of queries. python_sealog.lowering_index.LoweringResolverClient and
+sealog-queryLowering.py --socket speak this protocol.
+
+The index is rebuilt whenever Sealog publishes a change to a lowering or
+cruise, and every --sync-interval seconds in case an update was missed. If
+the websocket connection drops, queries are still answered and the periodic
+rebuilds carry on while it is retried with a growing delay.
+'''
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+
+import websockets
+
+from python_sealog.lowering_index import buildLoweringIndex
+from python_sealog.settings import headers, wsServerURL
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__file__)
+
+
+ARGS = None
+
+CLIENT_WSID = 'loweringResolver'
+
+HELLO = {
+    'type': 'hello',
+    'id': CLIENT_WSID,
+    'auth': {'headers': headers},
+    'version': '2',
+    'subs': ['/ws/status/newLowerings', '/ws/status/updateLowerings',
+             '/ws/status/deleteLowerings', '/ws/status/newCruises',
+             '/ws/status/updateCruises', '/ws/status/deleteCruises'],
+}
+
+PING = {
+    'type': 'ping',
+    'id': CLIENT_WSID,
+}
+
+# Seconds to wait before reconnecting to the websocket, doubled after each
+# failed attempt up to the maximum
+RECONNECT_DELAY = 1
+
+MAX_RECONNECT_DELAY = 60
+
+INDEX = None
+
+# Set when a lowering or cruise changes, to wake up the index refresher
+INDEX_STALE = None
+
+
+async def refresh_index():
+    global INDEX
+    INDEX = await asyncio.to_thread(buildLoweringIndex)
+    logger.info('Indexed %d lowerings', len(INDEX.intervals))
+
+
+# Rebuilds the index when told it is stale, or after --sync-interval seconds
+# otherwise. Changes that arrive during a rebuild trigger one more rebuild.
+async def index_refresher():
+    while True:
+        try:
+            await asyncio.wait_for(INDEX_STALE.wait(), ARGS.sync_interval)
+        except asyncio.TimeoutError:
+            pass
+        INDEX_STALE.clear()
+
+        try:
+            await refresh_index()
+        except:
+            logger.exception('Failed to refresh the lowering index')
+
+
+async def handle_client(reader, writer):
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+
+            match = INDEX.lookupText(line.decode().strip())
+            if match is None:
+                reply = 'null\tnull\n'
+            else:
+                reply = f'{match.lowering_id}\t{match.cruise_id or "null"}\n'
+            writer.write(reply.encode())
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def event_listener():
+    delay = RECONNECT_DELAY
+
+    while True:
+        try:
+            async with websockets.connect(wsServerURL) as websocket:
+                await websocket.send(json.dumps(HELLO))
+                logger.info('Connected to %s', wsServerURL)
+                delay = RECONNECT_DELAY
+
+                # Anything that changed while we were not subscribed needs
+                # picking up
+                INDEX_STALE.set()
+
+                while True:
+                    try:
+                        msg = json.loads(await websocket.recv())
+
+                        if msg.get('type') == 'ping':
+                            logger.debug('Acknowledging ping from server')
+                            await websocket.send(json.dumps(PING))
+                        elif msg.get('type') == 'pub':
+                            logger.debug('%s changed', msg.get('topic'))
+                            INDEX_STALE.set()
+                        else:
+                            logger.debug('Ignoring message of type '
+                                         f'{msg.get("type")}')
+                    except websockets.exceptions.ConnectionClosed:
+                        raise
+                    except Exception:
+                        logger.exception(
+                            'An exception occurred while processing a message')
+        except websockets.exceptions.ConnectionClosed:
+            logger.error('The connection to the server was lost')
+        except Exception:
+            logger.exception('Could not connect to the server')
+
+        logger.info('Reconnecting in %d seconds', delay)
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+
+async def main():
+    global INDEX_STALE
+    INDEX_STALE = asyncio.Event()
+
+    # Don't answer queries until there is something to answer them with
+    await refresh_index()
+
+    if os.path.exists(ARGS.socket):
+        os.unlink(ARGS.socket)
+    server = await asyncio.start_unix_server(handle_client, ARGS.socket)
+    os.chmod(ARGS.socket, ARGS.socket_mode)
+    logger.info('Listening on %s', ARGS.socket)
+
+    refresher = asyncio.create_task(index_refresher())
+    try:
+        async with server:
+            await event_listener()
+    finally:
+        refresher.cancel()
+        os.unlink(ARGS.socket)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--socket', default='/run/sealog/lowering-resolver.sock',
+                        help='Path of the Unix socket to listen on')
+    parser.add_argument('--socket-mode', type=lambda s: int(s, 8),
+                        default=0o666,
+                        help='Permissions of the socket, in octal')
+    parser.add_argument('--sync-interval', type=float, default=600,
+                        help='Seconds between full refreshes of the index')
+    ARGS = parser.parse_args()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
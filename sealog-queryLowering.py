@@ -2,67 +2,128 @@
 '''
 This script provides a command line interface for querying for lowering and
 cruise IDs given a timestamp.
+
+Lowerings and cruises are fetched once and kept in a local cache file, so
+repeated queries within --cache-ttl seconds do not touch the API. If a
+timestamp matches no lowering and the cache is more than a few seconds old,
+it is rebuilt once before giving up, in case the lowering is new.
+
+With --batch, timestamps or filenames containing a timestamp are read one
+per line from a file or stdin, and each is printed back with its lowering
+and cruise IDs, tab separated, with null where there is no match.
+
+With --socket, queries are answered by sealog-loweringResolver.py instead,
+falling back to the cache if the resolver is not running.
 '''
 
 import argparse
 import datetime
 import logging
+import os
 import sys
+import time
 
 import python_sealog.settings
-import time
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__file__)
 
+# Seconds old the lowering index must be before a lookup miss rebuilds it
+REBUILD_MIN_AGE = 5
+
 
-parser = argparse.ArgumentParser()
+parser = argparse.ArgumentParser(description=__doc__)
 parser.add_argument('--url', default=python_sealog.settings.apiServerURL)
 parser.add_argument('--get', dest='mode',
                     choices=('cruise', 'lowering', 'dive'), default='lowering')
 parser.add_argument('--time', default='now')
+parser.add_argument('--batch', nargs='?', const='-', metavar='FILE',
+                    help='Look up every timestamp or filename in FILE, or '
+                         'stdin if FILE is omitted or -')
+parser.add_argument('--cache',
+                    default=os.path.expanduser(
+                        '~/.cache/sealog/lowering-index.json'),
+                    help='Where to cache the lowering index')
+parser.add_argument('--cache-ttl', type=float, default=300,
+                    help='Seconds before the cached lowering index is '
+                         'refreshed, or 0 to always fetch it')
+parser.add_argument('--socket',
+                    help='Unix socket of sealog-loweringResolver.py to query '
+                         'instead of loading the index')
 args = parser.parse_args()
 
 
 # Override python_sealog's server URL, then do late import of API
 python_sealog.settings.apiServerURL = args.url
 
-import python_sealog.cruises
-import python_sealog.lowerings
+from python_sealog.lowering_index import LoweringResolverClient, \
+                                         loadLoweringIndex
 
 
 # Handle synonymous dive/lowering
 if args.mode == 'dive':
     args.mode = 'lowering'
 
-# Parse the timestamp
-fixzulu = lambda t: t.replace('Z', '+00:00')
-if args.time == 'now':
-    # Ridiculously, datetime.datetime.utcnow() is not timezone aware!
-    args.time = datetime.datetime.now(datetime.timezone.utc)
-else:
-    args.time = datetime.datetime.fromisoformat(fixzulu(args.time))
-
-# Find the first lowering that matches our timestamp
-for lowering in python_sealog.lowerings.getLowerings() or []:
-    start = datetime.datetime.fromisoformat(fixzulu(lowering['start_ts']))
-    stop  = datetime.datetime.fromisoformat(fixzulu(lowering['stop_ts']))
-    if start <= args.time < stop:
-        break
+# Ask the resolver service if there is one, otherwise load the index here
+resolver = None
+if args.socket:
+    try:
+        resolver = LoweringResolverClient(args.socket)
+    except OSError as error:
+        logger.warning('Could not reach the lowering resolver: %s', error)
+
+if resolver:
+    lookup = resolver.lookup
 else:
+    index = loadLoweringIndex(args.cache, args.cache_ttl)
+    rebuilt = False
+
+    def lookup(text):
+        global index, rebuilt
+
+        match = index.lookupText(text)
+        if match is None and not rebuilt and \
+                time.time() - index.built_at > REBUILD_MIN_AGE:
+            logger.info('No lowering found for %s, rebuilding the index', text)
+            index = loadLoweringIndex(args.cache, 0)
+            rebuilt = True
+            match = index.lookupText(text)
+
+        if match is None:
+            return None, None
+        return match.lowering_id, match.cruise_id
+
+
+if args.batch:
+    infile = sys.stdin if args.batch == '-' else open(args.batch)
+    with infile:
+        for line in infile:
+            line = line.rstrip('\n')
+            if not line:
+                continue
+
+            lowering_id, cruise_id = lookup(line)
+            print(f'{line}\t{lowering_id or "null"}\t{cruise_id or "null"}')
+    sys.exit(0)
+
+
+if args.time == 'now':
+    args.time = datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+# Find the lowering that matches our timestamp, and its cruise
+lowering_id, cruise_id = lookup(args.time)
+if lowering_id is None:
     print('null')
     sys.exit(1)
 
 if args.mode == 'lowering':
-    print(lowering['lowering_id'])
+    print(lowering_id)
     sys.exit(0)
 
-# Look up the cruise for this lowering
 assert args.mode == 'cruise'
-cruise = python_sealog.cruises.getCruiseByLowering(lowering['id'])
 
-if cruise is None:
+if cruise_id is None:
     print('null')
     sys.exit(1)
 
-print(cruise['cruise_id'])
+print(cruise_id)
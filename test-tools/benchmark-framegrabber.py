@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+'''
+This script measures the end-to-end latency of sealog-framegrabber.py against
+fake-framegrabber.py and a minimal stand-in for the Sealog server.
+
+For each combination of camera count and event rate, it starts a fake
+framegrabber and a framegrabber service, fires synthetic events at the service
+over the websocket, and reports percentiles of the time from event creation to
+all frames being on disk, and to the aux data being posted back to Sealog.
+'''
+
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import os
+import shlex
+import shutil
+import socket
+import sys
+import tempfile
+import time
+import uuid
+
+import websockets
+from aiohttp import web
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from python_sealog.settings import eventAuxDataAPIPath, loweringsAPIPath
+
+
+logging.basicConfig(level=logging.INFO)
+logging.getLogger('websockets').setLevel(logging.WARNING)
+logger = logging.getLogger(__file__)
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+FAKE_FRAMEGRABBER = os.path.join(REPO_DIR, 'test-tools', 'fake-framegrabber.py')
+FRAMEGRABBER = os.path.join(REPO_DIR, 'sealog-framegrabber.py')
+
+ARGS = None
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+# Plays the part of the Sealog server for one benchmark run: it accepts the
+# framegrabber's websocket connection, publishes events to it, and records
+# when aux data comes back.
+class FakeSealog:
+    def __init__(self, dest):
+        self.dest = dest
+        self.clients = set()
+        self.connected = asyncio.Event()
+        self.sent = {}
+        self.on_disk = {}
+        self.posted = {}
+        self.all_posted = asyncio.Event()
+        self.expected = 0
+
+    async def handle_websocket(self, websocket, path=None):
+        hello = json.loads(await websocket.recv())
+        logger.debug('Got hello from %s', hello.get('id'))
+        self.clients.add(websocket)
+        self.connected.set()
+        try:
+            await websocket.wait_closed()
+        finally:
+            self.clients.discard(websocket)
+
+    async def handle_aux_data(self, request):
+        now = time.time()
+        aux_data = await request.json()
+        event_id = aux_data['event_id']
+        self.posted[event_id] = now
+
+        # The last frame to be written determines when the event is on disk
+        mtimes = [
+            os.stat(os.path.join(self.dest, d['data_value'].lstrip('/')))
+              .st_mtime_ns / 1e9
+            for d in aux_data['data_array'] if d['data_name'] == 'filename'
+        ]
+        if mtimes:
+            self.on_disk[event_id] = max(mtimes)
+
+        if len(self.posted) >= self.expected:
+            self.all_posted.set()
+        return web.json_response({'insertedId': str(uuid.uuid4())})
+
+    # Every event belongs to the same lowering, which covers the whole run
+    async def handle_lowering_by_event(self, request):
+        return web.json_response({
+            'id': '0' * 24,
+            'lowering_id': 'BENCH-0001',
+            'start_ts': '1970-01-01T00:00:00.000Z',
+            'stop_ts': '9999-12-31T23:59:59.999Z',
+            'lowering_additional_meta': {},
+        })
+
+    async def send_event(self):
+        event_id = uuid.uuid4().hex[:24]
+        ts = datetime.datetime.utcnow()
+        msg = {
+            'type': 'pub',
+            'topic': '/ws/status/newEvents',
+            'message': {
+                'id': event_id,
+                'ts': ts.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z',
+                'event_value': 'ASNAP',
+                'event_options': [],
+                'event_free_text': '',
+            },
+        }
+        self.sent[event_id] = time.time()
+        await asyncio.gather(*(ws.send(json.dumps(msg)) for ws in self.clients))
+
+    def latencies(self, received):
+        return [
+            (received[event_id] - sent) * 1000
+            for event_id, sent in self.sent.items() if event_id in received
+        ]
+
+
+async def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise TimeoutError(f'Nothing is listening on port {port}')
+
+
+async def stop_process(proc):
+    if proc.returncode is None:
+        proc.terminate()
+        try:
+            await asyncio.wait_for(proc.wait(), 5)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+
+
+async def run_benchmark(cameras, rate):
+    dest = tempfile.mkdtemp(prefix='framegrabber-bench-')
+    sealog = FakeSealog(dest)
+    sealog.expected = ARGS.events
+
+    # Stand up the fake Sealog API and websocket servers
+    app = web.Application()
+    app.router.add_post(eventAuxDataAPIPath, sealog.handle_aux_data)
+    app.router.add_get(f'{loweringsAPIPath}/byevent/{{id}}',
+                       sealog.handle_lowering_by_event)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    api_port, ws_port, grabber_port = free_port(), free_port(), free_port()
+    await web.TCPSite(runner, '127.0.0.1', api_port).start()
+    ws_server = await websockets.serve(sealog.handle_websocket, '127.0.0.1',
+                                       ws_port)
+
+    procs = []
+    try:
+        procs.append(await asyncio.create_subprocess_exec(
+            sys.executable, FAKE_FRAMEGRABBER,
+            '--port', str(grabber_port),
+            '--cameras', str(cameras),
+            '--size', str(ARGS.size),
+            '--latency', str(ARGS.latency),
+            '--jitter', str(ARGS.jitter),
+            '--failure-rate', str(ARGS.failure_rate),
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL,
+        ))
+        await wait_for_port(grabber_port)
+
+        if ARGS.static_grabbers:
+            grabber_args = []
+            for n in range(1, cameras + 1):
+                grabber_args += [
+                    '--grabber', f'Camera{n}',
+                    f'http://127.0.0.1:{grabber_port}/frame/{n}.jpg',
+                    f'{{}}.Camera{n}.framegrab{n:02}.jpg',
+                ]
+        else:
+            grabber_args = ['--imaging-control',
+                            f'http://127.0.0.1:{grabber_port}']
+
+        procs.append(await asyncio.create_subprocess_exec(
+            sys.executable, FRAMEGRABBER,
+            '--dest', dest,
+            '--api-url', f'http://127.0.0.1:{api_port}',
+            '--ws-url', f'ws://127.0.0.1:{ws_port}',
+            *grabber_args,
+            *shlex.split(ARGS.framegrabber_args),
+            cwd=REPO_DIR,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=None if ARGS.verbose else asyncio.subprocess.DEVNULL,
+        ))
+        await asyncio.wait_for(sealog.connected.wait(), 10)
+
+        # Give the first imaging control heartbeat a chance to arrive
+        await asyncio.sleep(ARGS.warmup)
+
+        # Fire events on a fixed schedule
+        start = time.monotonic()
+        for i in range(ARGS.events):
+            await asyncio.sleep(max(0, start + i / rate - time.monotonic()))
+            await sealog.send_event()
+
+        try:
+            await asyncio.wait_for(sealog.all_posted.wait(), ARGS.drain)
+        except asyncio.TimeoutError:
+            logger.warning('Only %d of %d events were posted',
+                           len(sealog.posted), ARGS.events)
+    finally:
+        for proc in procs:
+            await stop_process(proc)
+        ws_server.close()
+        await ws_server.wait_closed()
+        await runner.cleanup()
+        shutil.rmtree(dest, ignore_errors=True)
+
+    return (sealog.latencies(sealog.on_disk), sealog.latencies(sealog.posted),
+            len(sealog.posted))
+
+
+async def main():
+    header = (f'{"cameras":>7} {"rate":>6} {"posted":>8}   '
+              f'{"disk p50":>8} {"p95":>8} {"p99":>8}   '
+              f'{"post p50":>8} {"p95":>8} {"p99":>8}')
+    rows = []
+    for cameras in ARGS.cameras:
+        for rate in ARGS.rates:
+            logger.info('Running %d events at %g/s with %d cameras',
+                        ARGS.events, rate, cameras)
+            on_disk, posted, count = await run_benchmark(cameras, rate)
+            rows.append(
+                f'{cameras:>7} {rate:>6g} {count:>4}/{ARGS.events:<3}   '
+                + ' '.join(f'{percentile(on_disk, p):>8.1f}'
+                           for p in (50, 95, 99))
+                + '   '
+                + ' '.join(f'{percentile(posted, p):>8.1f}'
+                           for p in (50, 95, 99))
+            )
+
+    print('Latency from event creation, in milliseconds')
+    print(header)
+    for row in rows:
+        print(row)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--cameras', default='1,2,4',
+                        type=lambda s: [int(x) for x in s.split(',')],
+                        help='Comma-separated camera counts to test')
+    parser.add_argument('--rates', default='1,5',
+                        type=lambda s: [float(x) for x in s.split(',')],
+                        help='Comma-separated event rates (per second)')
+    parser.add_argument('--events', type=int, default=50,
+                        help='Number of events to send for each combination')
+    parser.add_argument('--size', type=int, default=200*1024,
+                        help='Size of each frame in bytes')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='Framegrabber response latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='Framegrabber response jitter in seconds')
+    parser.add_argument('--failure-rate', type=float, default=0.0,
+                        help='Fraction of frame requests that fail')
+    parser.add_argument('--static-grabbers', action='store_true',
+                        help='Configure grabbers on the command line rather '
+                             'than through imaging control heartbeats')
+    parser.add_argument('--framegrabber-args', default='',
+                        help='Extra arguments for sealog-framegrabber.py')
+    parser.add_argument('--warmup', type=float, default=2.0,
+                        help='Seconds to wait after the service connects')
+    parser.add_argument('--drain', type=float, default=10.0,
+                        help='Seconds to wait for outstanding events')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Show the output of sealog-framegrabber.py')
+    ARGS = parser.parse_args()
+
+    asyncio.run(main())
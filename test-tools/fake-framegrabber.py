@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+'''
+This service stands in for the vehicle's framegrabbers and imaging control
+server so that sealog-framegrabber.py can be exercised without the real
+imaging hardware.
+
+Each camera serves a JPEG-like frame at /frame/<n>.jpg with a configurable
+size, latency, jitter and failure rate. A socket.io server on the /sealog
+namespace broadcasts SealogHeartbeat messages listing the cameras, just like
+the imaging control server does.
+'''
+
+import argparse
+import asyncio
+import logging
+import os
+import random
+
+import socketio
+from aiohttp import web
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__file__)
+
+
+ARGS = None
+
+SIO = socketio.AsyncServer(async_mode='aiohttp')
+
+# JPEG start and end of image markers, so the frames at least look the part
+SOI = b'\xff\xd8\xff\xe0'
+EOI = b'\xff\xd9'
+
+STATIC_FRAME = None
+
+
+def make_frame():
+    if ARGS.static:
+        return STATIC_FRAME
+    return SOI + os.urandom(ARGS.size - len(SOI) - len(EOI)) + EOI
+
+
+def framegrabbers(host):
+    return [
+        {
+            'camera_name': f'Camera{n}',
+            'url': f'http://{host}/frame/{n}.jpg',
+        }
+        for n in range(1, ARGS.cameras + 1)
+    ]
+
+
+async def handle_frame(request):
+    n = int(request.match_info['n'])
+    if not 1 <= n <= ARGS.cameras:
+        raise web.HTTPNotFound()
+
+    delay = ARGS.latency + random.uniform(-ARGS.jitter, ARGS.jitter)
+    await asyncio.sleep(max(delay, 0))
+
+    if random.random() < ARGS.failure_rate:
+        logger.debug('Failing request for camera %d', n)
+        raise web.HTTPServiceUnavailable()
+
+    return web.Response(body=make_frame(), content_type='image/jpeg')
+
+
+@SIO.on('connect', namespace='/sealog')
+async def on_connect(sid, environ):
+    logger.info('Imaging control client %s connected', sid)
+
+
+# Broadcasts the camera list to everyone connected to the imaging control
+# namespace.
+async def heartbeat_sender(app):
+    host = f'{ARGS.host}:{ARGS.port}'
+    while True:
+        await SIO.emit('SealogHeartbeat',
+                       {'framegrabbers': framegrabbers(host)},
+                       namespace='/sealog')
+        await asyncio.sleep(ARGS.heartbeat_interval)
+
+
+async def start_heartbeat(app):
+    if ARGS.heartbeat_interval > 0:
+        app['heartbeat'] = asyncio.create_task(heartbeat_sender(app))
+
+
+async def stop_heartbeat(app):
+    if 'heartbeat' in app:
+        app['heartbeat'].cancel()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--cameras', type=int, default=4,
+                        help='Number of framegrabbers to emulate')
+    parser.add_argument('--size', type=int, default=200*1024,
+                        help='Size of each frame in bytes')
+    parser.add_argument('--static', action='store_true',
+                        help='Serve the same frame every time, as a frozen '
+                             'camera feed would')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='Seconds to wait before serving a frame')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='Maximum random variation of the latency')
+    parser.add_argument('--failure-rate', type=float, default=0.0,
+                        help='Fraction of frame requests that fail')
+    parser.add_argument('--heartbeat-interval', type=float, default=1.0,
+                        help='Seconds between imaging control heartbeats, or '
+                             '0 to disable them')
+    ARGS = parser.parse_args()
+
+    STATIC_FRAME = SOI + os.urandom(ARGS.size - len(SOI) - len(EOI)) + EOI
+
+    app = web.Application()
+    app.router.add_get('/frame/{n}.jpg', handle_frame)
+    app.on_startup.append(start_heartbeat)
+    app.on_cleanup.append(stop_heartbeat)
+    SIO.attach(app)
+
+    web.run_app(app, host=ARGS.host, port=ARGS.port, print=None)